@@ -0,0 +1,367 @@
+"""
+A module with the storage backends of boolean matrices
+"""
+from typing import Callable, Tuple, Union
+import operator
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csc_array
+
+# the bitset takes less memory than CSC storage from about this density
+BITSET_MIN_DENSITY = 1 / 32
+# number of rows unpacked at once by the bitset operations
+_CHUNK_ROWS = 1 << 12
+
+if hasattr(np, "bitwise_count"):
+    _popcount = np.bitwise_count
+else:
+    _BYTE_COUNTS = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(words: np.ndarray) -> np.ndarray:
+        return _BYTE_COUNTS[words.view(np.uint8)]
+
+
+def _last_word_bits(cols: int) -> np.uint64:
+    """Returns the bits of the last word of a row that belong to the matrix"""
+    tail = cols % 64
+    return np.uint64(0xFFFFFFFFFFFFFFFF if tail == 0 else (1 << tail) - 1)
+
+
+class BitMatrix:
+    """
+    Boolean matrix packed into rows of uint64 words, the column `j` of a row
+    is the bit `j % 64` of its word `j // 64`.
+    The operators follow the boolean sparse arrays used by the engines:
+    `a + b` is the union, `a > b` is the difference and `a @ b` is the boolean product.
+    """
+
+    __array_ufunc__ = None
+    dtype = np.dtype(bool)
+
+    def __init__(self, words: np.ndarray, shape: Tuple[int, int]):
+        """
+        Initializes an instance of the BitMatrix class.
+
+        Parameters
+        ----------
+        words : numpy.ndarray
+            uint64 array with `shape[0]` rows of `ceil(shape[1] / 64)` words
+        shape : (int, int)
+            The shape of the matrix
+        """
+        self.words = words
+        self.shape = shape
+
+    @staticmethod
+    def zeros(shape: Tuple[int, int]) -> "BitMatrix":
+        """Returns the matrix without entries"""
+        return BitMatrix(np.zeros((shape[0], -(-shape[1] // 64)), np.uint64), shape)
+
+    @staticmethod
+    def from_coo(rows, cols, shape: Tuple[int, int]) -> "BitMatrix":
+        """Returns the matrix with the entries `(rows[i], cols[i])`"""
+        matrix = BitMatrix.zeros(shape)
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        if len(rows) == 0:
+            return matrix
+        keys = rows * matrix.words.shape[1] + (cols >> 6)
+        bits = np.left_shift(np.uint64(1), (cols & 63).astype(np.uint64))
+        order = np.argsort(keys, kind="stable")
+        keys, bits = keys[order], bits[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        matrix.words.flat[keys[starts]] = np.bitwise_or.reduceat(bits, starts)
+        return matrix
+
+    @staticmethod
+    def from_sparse(matrix) -> "BitMatrix":
+        """Packs a sparse array, a dense array or a BitMatrix"""
+        if isinstance(matrix, BitMatrix):
+            return matrix
+        rows, cols = matrix.nonzero()
+        return BitMatrix.from_coo(rows, cols, matrix.shape)
+
+    @staticmethod
+    def identity(n: int) -> "BitMatrix":
+        """Returns the identity matrix of size `n`"""
+        return BitMatrix.from_coo(np.arange(n), np.arange(n), (n, n))
+
+    @property
+    def nnz(self) -> int:
+        return int(_popcount(self.words).sum())
+
+    @property
+    def nbytes(self) -> int:
+        return self.words.nbytes
+
+    def _bits(self, start: int, stop: int) -> np.ndarray:
+        """Unpacks the rows `start:stop` into a dense boolean array"""
+        chunk = np.ascontiguousarray(self.words[start:stop])
+        bits = np.unpackbits(chunk.view(np.uint8), axis=1, bitorder="little")
+        return bits[:, : self.shape[1]].astype(bool)
+
+    def nonzero(self) -> Tuple[np.ndarray, np.ndarray]:
+        rows, cols = [], []
+        for start in range(0, self.shape[0], _CHUNK_ROWS):
+            r, c = np.nonzero(self._bits(start, start + _CHUNK_ROWS))
+            rows.append(r + start)
+            cols.append(c)
+        if not rows:
+            return np.array([], dtype=np.intp), np.array([], dtype=np.intp)
+        return np.concatenate(rows), np.concatenate(cols)
+
+    def toarray(self) -> np.ndarray:
+        return self._bits(0, self.shape[0])
+
+    def tocsc(self) -> csc_array:
+        rows, cols = self.nonzero()
+        return csc_array(
+            (np.ones(len(rows), dtype=bool), (rows, cols)), shape=self.shape, dtype=bool
+        )
+
+    def tocsr(self) -> sparse.csr_array:
+        return sparse.csr_array(self.tocsc())
+
+    def copy(self) -> "BitMatrix":
+        return BitMatrix(self.words.copy(), self.shape)
+
+    def __getitem__(self, key) -> Union["BitMatrix", csc_array]:
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        words = self.words[rows]
+        if words.ndim == 1:
+            words = words[None, :]
+        selected = BitMatrix(words, (words.shape[0], self.shape[1]))
+        if isinstance(cols, slice) and cols == slice(None):
+            return selected
+        return selected.tocsc()[:, cols]
+
+    def __or__(self, other) -> "BitMatrix":
+        return BitMatrix(self.words | BitMatrix.from_sparse(other).words, self.shape)
+
+    __add__ = __or__
+    __radd__ = __or__
+    __ror__ = __or__
+
+    def __and__(self, other) -> "BitMatrix":
+        return BitMatrix(self.words & BitMatrix.from_sparse(other).words, self.shape)
+
+    __rand__ = __and__
+
+    def __gt__(self, other) -> "BitMatrix":
+        return BitMatrix(self.words & ~BitMatrix.from_sparse(other).words, self.shape)
+
+    def __lt__(self, other) -> "BitMatrix":
+        # the reflection of `other > self`
+        return BitMatrix(BitMatrix.from_sparse(other).words & ~self.words, self.shape)
+
+    def __matmul__(self, other) -> "BitMatrix":
+        return self.masked_matmul(other)
+
+    def masked_matmul(self, other, mask=None) -> "BitMatrix":
+        """
+        Computes the entries of the boolean product `self @ other`
+        that are not set in `mask`. The rows that are full in `mask` are skipped.
+        """
+        other = BitMatrix.from_sparse(other)
+        result = BitMatrix.zeros((self.shape[0], other.shape[1]))
+        free = None
+        if mask is not None:
+            free = ~BitMatrix.from_sparse(mask).words
+            free[:, -1:] &= _last_word_bits(other.shape[1])
+            open_rows = free.any(axis=1)
+        for start in range(0, self.shape[0], _CHUNK_ROWS):
+            rows, inner = np.nonzero(self._bits(start, start + _CHUNK_ROWS))
+            rows += start
+            if free is not None:
+                keep = open_rows[rows]
+                rows, inner = rows[keep], inner[keep]
+            if len(rows) == 0:
+                continue
+            # every row of the result is the union of the rows of `other`
+            # selected by its bits, one union over whole words per inner index
+            order = np.argsort(inner, kind="stable")
+            rows, inner = rows[order], inner[order]
+            bounds = np.flatnonzero(np.r_[True, inner[1:] != inner[:-1], True])
+            for lo, hi in zip(bounds[:-1], bounds[1:]):
+                result.words[rows[lo:hi]] |= other.words[inner[lo]]
+        if free is not None:
+            result.words &= free
+        return result
+
+    def __rmatmul__(self, other) -> "BitMatrix":
+        return BitMatrix.from_sparse(other) @ self
+
+
+class MatrixBackend:
+    """
+    Storage of the boolean matrices, the matrices of every backend
+    support the union `+`, the difference `>`, the product `@`, `nnz` and `nonzero()`
+    """
+
+    name = None
+
+    def zeros(self, shape: Tuple[int, int]):
+        """Returns the matrix without entries"""
+        raise NotImplementedError
+
+    def identity(self, n: int):
+        """Returns the identity matrix of size `n`"""
+        raise NotImplementedError
+
+    def from_coo(self, rows, cols, shape: Tuple[int, int]):
+        """Returns the matrix with the entries `(rows[i], cols[i])`"""
+        raise NotImplementedError
+
+    def convert(self, matrix):
+        """Returns `matrix` stored by the backend"""
+        raise NotImplementedError
+
+
+class SparseBackend(MatrixBackend):
+    """Boolean `scipy.sparse.csc_array` matrices"""
+
+    name = "sparse"
+
+    def zeros(self, shape):
+        return csc_array(shape, dtype=bool)
+
+    def identity(self, n):
+        return sparse.identity(n, dtype=bool, format="csc")
+
+    def from_coo(self, rows, cols, shape):
+        return csc_array(
+            (np.ones(len(rows), dtype=bool), (rows, cols)), shape=shape, dtype=bool
+        )
+
+    def convert(self, matrix):
+        if isinstance(matrix, BitMatrix):
+            return matrix.tocsc()
+        return csc_array(matrix)
+
+
+class BitsetBackend(MatrixBackend):
+    """Bit-packed `BitMatrix` matrices"""
+
+    name = "bitset"
+
+    def zeros(self, shape):
+        return BitMatrix.zeros(shape)
+
+    def identity(self, n):
+        return BitMatrix.identity(n)
+
+    def from_coo(self, rows, cols, shape):
+        return BitMatrix.from_coo(rows, cols, shape)
+
+    def convert(self, matrix):
+        return BitMatrix.from_sparse(matrix)
+
+
+BACKENDS = {backend.name: backend for backend in (SparseBackend(), BitsetBackend())}
+
+
+def density(matrix) -> float:
+    """Returns the share of the nonzero entries of the matrix"""
+    size = matrix.shape[0] * matrix.shape[1]
+    return matrix.nnz / size if size else 0.0
+
+
+def get_backend(
+    backend: Union[str, MatrixBackend] = None, matrix=None
+) -> MatrixBackend:
+    """
+    Returns the backend by name. The sparse backend is the default one,
+    "auto" selects the bitset backend if `matrix` is dense enough.
+
+    Parameters
+    ----------
+    backend: str or `MatrixBackend` or None
+        "sparse", "bitset", "auto", a backend instance or None
+    matrix: sparse array or `BitMatrix`, optional
+        The matrix whose density is used by "auto"
+
+    Returns
+    -------
+    backend: `MatrixBackend`
+    """
+    if isinstance(backend, MatrixBackend):
+        return backend
+    if backend is None:
+        return BACKENDS["sparse"]
+    if backend == "auto":
+        dense = matrix is not None and density(matrix) >= BITSET_MIN_DENSITY
+        return BACKENDS["bitset" if dense else "sparse"]
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown matrix backend {backend}")
+    return BACKENDS[backend]
+
+
+def adapt(matrix, backend: Union[str, MatrixBackend] = None):
+    """
+    Moves a sparse matrix to the bitset backend when it becomes dense
+    if the backend is "auto", other matrices are returned as is.
+    """
+    if backend != "auto" or isinstance(matrix, BitMatrix):
+        return matrix
+    if density(matrix) >= BITSET_MIN_DENSITY:
+        return BitMatrix.from_sparse(matrix)
+    return matrix
+
+
+def to_backend(matrix, backend: Union[str, MatrixBackend] = None):
+    """
+    Returns `matrix` stored by the backend, "auto" keeps sparse matrices
+    that are not dense enough and None keeps the matrix as is.
+    """
+    if backend is None:
+        return matrix
+    if backend == "auto":
+        return adapt(matrix, backend)
+    return get_backend(backend).convert(matrix)
+
+
+def masked_matmul(left, right, mask, multiply: Callable = operator.matmul):
+    """
+    Computes `C<not M> = A @ B`: the entries of the boolean product `left @ right`
+    that are not set in `mask`, without building the union with `mask`.
+    The rows and the columns that are full in `mask` are excluded
+    from the product, so they cost nothing once they are known.
+
+    Parameters
+    ----------
+    left: sparse array or `BitMatrix`
+        Left boolean matrix
+    right: sparse array or `BitMatrix`
+        Right boolean matrix
+    mask: sparse array or `BitMatrix`
+        The known entries
+    multiply: callable
+        Product of the sparse matrices, `@` by default
+
+    Returns
+    -------
+    product: `~scipy.sparse.csc_array` or `BitMatrix`
+        The new entries, a bitset if any of the matrices is a bitset
+    """
+    if any(isinstance(m, BitMatrix) for m in (left, right, mask)):
+        return BitMatrix.from_sparse(left).masked_matmul(right, mask)
+    rows, cols = left.shape[0], right.shape[1]
+    if mask.nnz == 0:
+        return csc_array(multiply(left, right))
+    mask = csc_array(mask)
+    open_rows = np.bincount(mask.indices, minlength=rows) < cols
+    open_cols = np.diff(mask.indptr) < rows
+    if open_rows.all() and open_cols.all():
+        return csc_array(multiply(left, right) > mask)
+    row_ids, col_ids = np.flatnonzero(open_rows), np.flatnonzero(open_cols)
+    if len(row_ids) == 0 or len(col_ids) == 0:
+        return csc_array((rows, cols), dtype=bool)
+    left = sparse.csr_array(left)[row_ids]
+    product = multiply(left, csc_array(right)[:, col_ids])
+    product = product > mask[row_ids][:, col_ids]
+    frm, to = product.nonzero()
+    return csc_array(
+        (np.ones(len(frm), dtype=bool), (row_ids[frm], col_ids[to])),
+        shape=(rows, cols),
+        dtype=bool,
+    )
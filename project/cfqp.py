@@ -1,14 +1,30 @@
 from abc import ABC
-from typing import Set, Tuple
-from pyformlang.cfg import CFG
-from networkx import MultiDiGraph
-from project.graph_utils import load_graph_from_file
-from project.wcnf import wcnf_from_file, to_wcnf
+from collections import defaultdict, deque, namedtuple
+from functools import reduce
+from typing import Dict, Iterable, List, Set, Tuple, Union
+from pyformlang.cfg import CFG, Variable
+from pyformlang.regular_expression import Regex
+from networkx import MultiDiGraph, DiGraph, condensation, topological_sort
+from project.graph_utils import LabeledGraph, as_labeled_graph, load_graph_from_file
+from project.wcnf import CompiledGrammar, compile_grammar, compiled_grammar_from_file
 from enum import Enum
-from project.fa_utils import array_type
-
-
-def hellings_rpq(graph: MultiDiGraph, cfg: CFG) -> Set[Tuple]:
+from project.fa_utils import (
+    array_type,
+    boolean_decomposition,
+    epsilon_free,
+    transitive_closure,
+)
+from project.ecfg import ECFG
+from project.parallel import matmul
+from project.backends import MatrixBackend, adapt, get_backend, masked_matmul
+from project.rsm import RSM
+from scipy import sparse
+import numpy as np
+
+
+def hellings_rpq(
+    graph: Union[MultiDiGraph, LabeledGraph], cfg: Union[CFG, CompiledGrammar]
+) -> Set[Tuple]:
     """
     Solve the reachability problem between all pairs of vertices
     for a given graph `graph`<V, E, L> and a given CF<N, E, P, S> grammar `cfq`.
@@ -16,9 +32,9 @@ def hellings_rpq(graph: MultiDiGraph, cfg: CFG) -> Set[Tuple]:
 
      Parameters
      ----------
-     graph : `~networkx.MultiDiGraph`
+     graph : `~networkx.MultiDiGraph` or `LabeledGraph`
          A source database
-     cfq : ~`pyformlang.cfg import CFG`
+     cfq : ~`pyformlang.cfg import CFG` or `CompiledGrammar`
          Context-free grammar that defines constraints
 
      Returns
@@ -28,60 +44,209 @@ def hellings_rpq(graph: MultiDiGraph, cfg: CFG) -> Set[Tuple]:
         * non_terminal of the cfg\
         * final vertex
     """
-    wcfq = to_wcnf(cfg)
-    E = graph.edges(data="label")
-    V = graph.nodes()
-    P = wcfq.productions
-    # rules like N_i -> eps \in P
-    non_term_to_eps = {p.head.value for p in P if not p.body}
-    # non term to term: N -> t
-    NT = {(p.head.value, p.body[0].value) for p in P if len(p.body) == 1}
-    # non term to 2 non term: N -> NN
-    NN = {p for p in P if len(p.body) == 2}
-
-    result = {
-        # loop in graph with label N_i -> eps
-        (u, N_i, u)
-        for u in V
-        for N_i in non_term_to_eps
-    } | {
-        # add all productions to terminals
-        (v, N, u)
-        for (v, u, t) in E
-        for (N, t2) in NT
-        if t2 == t
-    }
-
-    m = result.copy()
-    while len(m) > 0:
-        tmp_result = set()
-        v, Ni, u = m.pop()
+    grammar = compile_grammar(cfg)
+    heads_by_body = grammar.heads_by_body
+    rights_by_left = grammar.rights_by_left
+    lefts_by_right = grammar.lefts_by_right
+
+    # incoming[u][N] = {v | (v, N, u) in result}
+    incoming = defaultdict(lambda: defaultdict(set))
+    # outgoing[v][N] = {u | (v, N, u) in result}
+    outgoing = defaultdict(lambda: defaultdict(set))
+    result = set()
+    m = deque()
+
+    def add_fact(v, N, u):
+        if u in outgoing[v][N]:
+            return
+        outgoing[v][N].add(u)
+        incoming[u][N].add(v)
+        result.add((v, N, u))
+        m.append((v, N, u))
+
+    graph = as_labeled_graph(graph)
+    # loop in graph with label N_i -> eps
+    for u in range(graph.number_of_nodes()):
+        for N in grammar.eps_heads:
+            add_fact(u, N, u)
+    # add all productions to terminals
+    for t, array in graph.arrays.items():
+        heads = grammar.heads_by_term.get(grammar.term_ids.get(t), ())
+        if not heads:
+            continue
+        frm, to = array.nonzero()
+        for v, u in zip(frm.tolist(), to.tolist()):
+            for N in heads:
+                add_fact(v, N, u)
+
+    while m:
+        v, Ni, u = m.popleft()
         # x -> v -> u
-        for x, Nj, to in result:
-            if v == to:
-                for p in NN:
-                    Nk = p.head.value
-                    NjNi = p.body
-                    if (x, Nk, u) not in result and NjNi == [Nj, Ni]:
-                        m.add((x, Nk, u))
-                        tmp_result.add((x, Nk, u))
-        for r in tmp_result:
-            result.add(r)
+        for Nj in lefts_by_right.get(Ni, ()):
+            heads = heads_by_body[(Nj, Ni)]
+            for x in tuple(incoming[v][Nj]):
+                for Nk in heads:
+                    add_fact(x, Nk, u)
         # v -> u -> x
-        for frm, Nj, x in result:
-            if u == frm:
-                for p in NN:
-                    Nk = p.head.value
-                    NiNj = p.body
-                    if (v, Nk, x) not in result and NiNj == [Ni, Nj]:
-                        m.add((v, Nk, x))
-                        tmp_result.add((v, Nk, x))
-        for r in tmp_result:
-            result.add(r)
-    return result
+        for Nj in rights_by_left.get(Ni, ()):
+            heads = heads_by_body[(Ni, Nj)]
+            for x in tuple(outgoing[u][Nj]):
+                for Nk in heads:
+                    add_fact(v, Nk, x)
+    nodes = graph.nodes
+    names = [var.value for var in grammar.variables]
+    return {(nodes[v], names[N], nodes[u]) for v, N, u in result}
+
+
+MatrixStats = namedtuple("MatrixStats", ["multiplications", "skipped"])
+MatrixClosure = namedtuple("MatrixClosure", ["matrices", "nodes", "stats"])
+
+
+def _components_bottom_up(var_prods):
+    """
+    Splits the nonterminals of binary productions `N_k -> N_i N_j` into strongly
+    connected components of their dependency graph and yields them so that
+    every component comes after all components it depends on.
+    """
+    deps = DiGraph()
+    for head, left, right in var_prods:
+        deps.add_edge(left, head)
+        deps.add_edge(right, head)
+    condensed = condensation(deps)
+    for component in topological_sort(condensed):
+        yield condensed.nodes[component]["members"]
+
+
+def _solve_matrices(matrices, var_prods, workers: int = 1, backend=None) -> MatrixStats:
+    """
+    Computes the fixed point of the binary productions `var_prods` over
+    the nonterminal matrices `matrices` in place.
+
+    Components of the grammar dependency graph are solved bottom-up,
+    so the bodies from lower components are final when a component is processed.
+    Inside a component a production is fired only for the body matrices
+    that have changed since its previous firing, and the entries already known
+    in the matrix of its head are masked out of the product.
 
+    Returns
+    -------
+    stats: `MatrixStats`
+        The number of performed sparse products and the number of products
+        skipped because the corresponding body matrix did not change
+    """
+    multiply = matmul(workers)
+    multiplications = 0
+    skipped = 0
+    for component in _components_bottom_up(var_prods):
+        prods = [(h, l, r) for h, l, r in var_prods if h in component]
+        if not prods:
+            continue
+        recursive = any(l in component or r in component for _, l, r in prods)
+
+        # the first firing sees every body matrix as changed
+        derived = defaultdict(list)
+        for head, left, right in prods:
+            derived[head].append(
+                masked_matmul(matrices[left], matrices[right], matrices[head], multiply)
+            )
+            multiplications += 1
+
+        while True:
+            delta = dict()
+            for var, products in derived.items():
+                # the products are masked by the matrix of the head
+                new = reduce(lambda a, b: a + b, products)
+                if new.nnz > 0:
+                    delta[var] = new
+                    matrices[var] = adapt(matrices[var] + new, backend)
+            if not recursive or not delta:
+                break
+
+            derived = defaultdict(list)
+            for head, left, right in prods:
+                if left in delta:
+                    derived[head].append(
+                        masked_matmul(
+                            delta[left], matrices[right], matrices[head], multiply
+                        )
+                    )
+                    multiplications += 1
+                else:
+                    skipped += 1
+                if right in delta:
+                    derived[head].append(
+                        masked_matmul(
+                            matrices[left], delta[right], matrices[head], multiply
+                        )
+                    )
+                    multiplications += 1
+                else:
+                    skipped += 1
+    return MatrixStats(multiplications, skipped)
+
+
+def matrix_closure(
+    graph: Union[MultiDiGraph, LabeledGraph],
+    cfg: Union[CFG, CompiledGrammar],
+    workers: int = 1,
+    backend: Union[str, MatrixBackend] = None,
+) -> MatrixClosure:
+    """
+    Computes the boolean matrices of every nonterminal of the grammar `cfg`
+    in weakened Chomsky normal form over the graph `graph`.
+
+    Parameters
+    ----------
+    graph : `~networkx.MultiDiGraph` or `LabeledGraph`
+        A source database
+    cfq : ~`pyformlang.cfg import CFG` or `CompiledGrammar`
+        Context-free grammar that defines constraints
+    workers: int
+        Number of processes multiplying the row blocks of the matrices
+    backend: str or `~project.backends.MatrixBackend` or None
+        Storage of the matrices: "sparse" (default), "bitset" or "auto"
+        to switch to bitsets when a matrix becomes dense
 
-def matrix_rpq(graph: MultiDiGraph, cfg: CFG) -> Set[Tuple]:
+    Returns
+    -------
+    closure: `MatrixClosure`
+        The named tuple, where
+        `matrices` - dictionary with nonterminal and its boolean matrix
+        `nodes` - list with nodes of graph (fixed indexes)
+        `stats` - `MatrixStats` of the fixed point computation
+    """
+    grammar = compile_grammar(cfg)
+    graph = as_labeled_graph(graph)
+    n = graph.number_of_nodes()
+    var_prods = {
+        (head, left, right)
+        for (left, right), heads in grammar.heads_by_body.items()
+        for head in heads
+    }
+
+    storage = get_backend(None if backend == "auto" else backend)
+    matrices = {var: storage.zeros((n, n)) for var in grammar.var_ids.values()}
+    for label, array in graph.arrays.items():
+        heads = grammar.heads_by_term.get(grammar.term_ids.get(label), ())
+        if heads:
+            array = storage.convert(array)
+        for var in heads:
+            matrices[var] = matrices[var] + array
+    for var in grammar.eps_heads:
+        matrices[var] = matrices[var] + storage.identity(n)
+    matrices = {var: adapt(matrix, backend) for var, matrix in matrices.items()}
+
+    stats = _solve_matrices(matrices, var_prods, workers, backend)
+    matrices = {grammar.variables[var]: matrix for var, matrix in matrices.items()}
+    return MatrixClosure(matrices, graph.nodes, stats)
+
+
+def matrix_rpq(
+    graph: Union[MultiDiGraph, LabeledGraph],
+    cfg: Union[CFG, CompiledGrammar],
+    workers: int = 1,
+    backend: Union[str, MatrixBackend] = None,
+) -> Set[Tuple]:
     """
     Solve the reachability problem between all pairs of vertices
     for a given graph `graph`<V, E, L> and a given CF<N, E, P, S> grammar `cfq`.
@@ -89,10 +254,14 @@ def matrix_rpq(graph: MultiDiGraph, cfg: CFG) -> Set[Tuple]:
 
      Parameters
      ----------
-     graph : `~networkx.MultiDiGraph`
+     graph : `~networkx.MultiDiGraph` or `LabeledGraph`
          A source database
-     cfq : ~`pyformlang.cfg import CFG`
+     cfq : ~`pyformlang.cfg import CFG` or `CompiledGrammar`
          Context-free grammar that defines constraints
+     workers: int
+         Number of processes multiplying the row blocks of the matrices
+     backend: str or `~project.backends.MatrixBackend` or None
+         Storage of the matrices: "sparse" (default), "bitset" or "auto"
 
      Returns
      -------
@@ -101,58 +270,295 @@ def matrix_rpq(graph: MultiDiGraph, cfg: CFG) -> Set[Tuple]:
         * non_terminal of the cfg
         * final vertex
     """
-    wcfg = to_wcnf(cfg)
+    matrices, node_by_idx, _ = matrix_closure(graph, cfg, workers, backend)
+    result = set()
+    for variable, matrix in matrices.items():
+        rows_idx, cols_idx = matrix.nonzero()
+        for i, j in zip(rows_idx, cols_idx):
+            result.add((node_by_idx[i], variable, node_by_idx[j]))
+    return result
+
+
+class CFPQIndex:
+    """
+    The boolean matrices of every nonterminal of the grammar over a growing graph,
+    the matrices are kept up to date under edge insertions
+    """
+
+    def __init__(self, grammar: CompiledGrammar, nodes: List, matrices: Dict):
+        """
+        Initializes an instance of the CFPQIndex class.
+
+        Parameters
+        ----------
+        grammar : `CompiledGrammar`
+            The compiled WCNF of the grammar
+        nodes : list
+            The node of every matrix index
+        matrices : dict of int and `array_type`
+            Transitively closed boolean matrix of every nonterminal id of `grammar`
+        """
+        self.grammar = grammar
+        self.nodes = list(nodes)
+        self.idx = {node: i for i, node in enumerate(self.nodes)}
+        self.matrices = matrices
+        self._var_prods = [
+            (head, left, right)
+            for (left, right), heads in grammar.heads_by_body.items()
+            for head in heads
+        ]
+
+    @staticmethod
+    def from_graph(
+        graph: Union[MultiDiGraph, LabeledGraph], cfg: Union[CFG, CompiledGrammar]
+    ) -> "CFPQIndex":
+        """
+        Builds the index of `graph` with the matrix algorithm.
+
+        Parameters
+        ----------
+        graph : `~networkx.MultiDiGraph` or `LabeledGraph`
+            A source database
+        cfq : ~`pyformlang.cfg import CFG` or `CompiledGrammar`
+            Context-free grammar that defines constraints
+
+        Returns
+        -------
+        CFPQIndex
+            The index with the nonterminal matrices of `graph`
+        """
+        grammar = compile_grammar(cfg)
+        matrices, nodes, _ = matrix_closure(graph, grammar)
+        return CFPQIndex(
+            grammar,
+            nodes.tolist() if isinstance(nodes, np.ndarray) else nodes,
+            {grammar.var_ids[var]: matrix for var, matrix in matrices.items()},
+        )
+
+    def triples(self) -> Set[Tuple]:
+        """
+        Returns all the triples of the index in the form of `matrix_rpq` result.
+        """
+        return self._triples(self.matrices)
+
+    def add_edges(self, edges: Iterable[Tuple]) -> Set[Tuple]:
+        """
+        Inserts the edges into the graph and derives their consequences.
+        Only the new entries of the matrices are multiplied on every step,
+        so the update cost depends on the size of the change.
+
+        Parameters
+        ----------
+        edges : iterable of (node, label, node)
+            The new edges, the nodes missing in the graph are added
+
+        Returns
+        -------
+        A set of the newly derived triples of the form:
+            * start vertex
+            * non_terminal of the cfg
+            * final vertex
+        """
+        grammar = self.grammar
+        edges = list(edges)
+        n_old = len(self.nodes)
+        for v, _, u in edges:
+            for node in (v, u):
+                if node not in self.idx:
+                    self.idx[node] = len(self.nodes)
+                    self.nodes.append(node)
+        n = len(self.nodes)
+
+        rows = defaultdict(list)
+        cols = defaultdict(list)
+        if n > n_old:
+            for matrix in self.matrices.values():
+                matrix.resize((n, n))
+            for head in grammar.eps_heads:
+                rows[head].extend(range(n_old, n))
+                cols[head].extend(range(n_old, n))
+        for v, label, u in edges:
+            for head in grammar.heads_by_term.get(grammar.term_ids.get(label), ()):
+                rows[head].append(self.idx[v])
+                cols[head].append(self.idx[u])
+        derived = {
+            head: array_type(
+                (np.ones(len(rows[head]), dtype=bool), (rows[head], cols[head])),
+                shape=(n, n),
+                dtype=bool,
+            )
+            for head in rows
+        }
+
+        added = dict()
+        while True:
+            delta = dict()
+            for var, matrix in derived.items():
+                new = matrix > self.matrices[var]
+                if new.nnz > 0:
+                    delta[var] = new
+                    self.matrices[var] = self.matrices[var] + new
+                    added[var] = added[var] + new if var in added else new
+            if not delta:
+                break
+            products = defaultdict(list)
+            for head, left, right in self._var_prods:
+                if left in delta:
+                    products[head].append(
+                        masked_matmul(
+                            delta[left], self.matrices[right], self.matrices[head]
+                        )
+                    )
+                if right in delta:
+                    products[head].append(
+                        masked_matmul(
+                            self.matrices[left], delta[right], self.matrices[head]
+                        )
+                    )
+            derived = {
+                head: reduce(lambda a, b: a + b, prods)
+                for head, prods in products.items()
+            }
+        return self._triples(added)
+
+    def _triples(self, matrices) -> Set[Tuple]:
+        result = set()
+        for var, matrix in matrices.items():
+            rows_idx, cols_idx = matrix.nonzero()
+            for i, j in zip(rows_idx.tolist(), cols_idx.tolist()):
+                result.add((self.nodes[i], self.grammar.variables[var], self.nodes[j]))
+        return result
+
+
+def _rsm_from_cfg(cfg: CFG) -> RSM:
+    """
+    Builds an RSM with one box per nonterminal of `cfg`,
+    the box accepts the union of the bodies of the nonterminal productions.
+    """
+    bodies = defaultdict(list)
+    for p in cfg.productions:
+        body = " ".join(symbol.value for symbol in p.body) if p.body else "$"
+        bodies[p.head].append(f"({body})")
+    productions = {head: Regex(" | ".join(b)) for head, b in bodies.items()}
+    return RSM.from_ecfg(ECFG(productions, cfg.start_symbol))
+
+
+def tensor_rpq(
+    graph: Union[MultiDiGraph, LabeledGraph],
+    grammar: Union[CFG, CompiledGrammar, RSM],
+) -> Set[Tuple]:
+    """
+    Solve the reachability problem between all pairs of vertices
+    for a given graph `graph`<V, E, L> and a given CF<N, E, P, S> grammar `cfq`.
+    Based on the Tensor algorithm: the closure of the Kronecker product
+    of the RSM and the graph boolean decompositions.
+
+     Parameters
+     ----------
+     graph : `~networkx.MultiDiGraph` or `LabeledGraph`
+         A source database
+     grammar : ~`pyformlang.cfg import CFG`, `CompiledGrammar` or `RSM`
+         Context-free grammar or recursive state machine that defines constraints.
+         The grammar is not converted to WCNF, so the result contains only
+         its own nonterminals.
+
+     Returns
+     -------
+     A a set of triples of the form:
+        * start vertex
+        * non_terminal of the cfg
+        * final vertex
+    """
+    if isinstance(grammar, CompiledGrammar):
+        grammar = grammar.to_cfg()
+    rsm = grammar if isinstance(grammar, RSM) else _rsm_from_cfg(grammar)
+    graph = as_labeled_graph(graph)
     n = graph.number_of_nodes()
-    E = graph.edges(data="label")
-    idx_by_node = dict()
-    node_by_idx = [x for x in graph.nodes()]
-    i = 0
-    for v in node_by_idx:
-        idx_by_node[v] = i
-        i += 1
-    P = wcfg.productions
-    eps_prods = {p.head.value for p in P if not p.body}
-    term_prods = {(p.head.value, p.body[0].value) for p in P if len(p.body) == 1}
-    var_prods = {
-        (p.head.value, p.body[0].value, p.body[1].value) for p in P if len(p.body) == 2
+
+    # join the boxes into one block-diagonal decomposition of the RSM
+    rsm_rows = defaultdict(list)
+    rsm_cols = defaultdict(list)
+    boxes = dict()
+    k = 0
+    for var, nfa in rsm._transitions.items():
+        # the epsilon-free box is decomposed once and reused for its start and final states
+        box = epsilon_free(nfa)
+        arrays, idxs, states = boolean_decomposition(box)
+        starts = [k + idxs[st] for st in box.start_states]
+        finals = [k + idxs[st] for st in box.final_states]
+        boxes[var.value] = (var, starts, finals)
+        for symbol, array in arrays.items():
+            frm, to = array.nonzero()
+            rsm_rows[symbol.value].extend(k + frm)
+            rsm_cols[symbol.value].extend(k + to)
+        k += len(states)
+    rsm_arrays = {
+        symbol: array_type(
+            (
+                np.ones(len(rsm_rows[symbol]), dtype=bool),
+                (rsm_rows[symbol], rsm_cols[symbol]),
+            ),
+            shape=(k, k),
+            dtype=bool,
+        )
+        for symbol in rsm_rows
     }
 
-    matrices = dict()
-    x = wcfg.variables
-    matrices = {variable: array_type((n, n), dtype=bool) for variable in wcfg.variables}
-    for frm, to, x in E:
-        for var, term in term_prods:
-            if x == term:
-                matrices[var][idx_by_node[frm], idx_by_node[to]] = True
-
-    for var in eps_prods:
-        for i in range(n):
-            matrices[var][i, i] = True
-
-    is_modified = True
-    while is_modified:
-        is_modified = False
-        for res_var, frm, to in var_prods:
-            for i in range(n):
-                for j in range(n):
-                    for k in range(n):
-                        if matrices[frm][i, k] and matrices[to][k, j]:
-                            if not matrices[res_var][i, j]:
-                                matrices[res_var][i, j] = True
-                                is_modified = True
+    graph_arrays = {
+        symbol: array_type(graph.arrays[symbol])
+        if symbol in graph.arrays
+        else array_type((n, n), dtype=bool)
+        for symbol in set(rsm_arrays) | set(boxes)
+    }
+    for name, (_, starts, finals) in boxes.items():
+        if set(starts) & set(finals):
+            identity = sparse.identity(n, dtype=bool, format="csc")
+            graph_arrays[name] = graph_arrays[name] + identity
+
+    edges = reduce(
+        lambda a, b: a + b,
+        (
+            sparse.kron(rsm_arrays[symbol], graph_arrays[symbol], format="csc")
+            for symbol in rsm_arrays
+        ),
+        array_type((k * n, k * n), dtype=bool),
+    )
+    closure = array_type((k * n, k * n), dtype=bool)
+    while edges.nnz > 0:
+        closure = transitive_closure(edges, closure)
+        # only the new nonterminal edges are added to the product
+        edges = array_type((k * n, k * n), dtype=bool)
+        for name, (_, starts, finals) in boxes.items():
+            new = array_type((n, n), dtype=bool)
+            for s in starts:
+                for f in finals:
+                    new = new + closure[s * n : (s + 1) * n, f * n : (f + 1) * n]
+            new = new > graph_arrays[name]
+            if new.nnz == 0:
+                continue
+            graph_arrays[name] = graph_arrays[name] + new
+            if name in rsm_arrays:
+                edges = edges + sparse.kron(rsm_arrays[name], new, format="csc")
+
     result = set()
-    for variable in wcfg.variables:
-        rows, cols = matrices[variable].nonzero()
-        for i in range(len(rows)):
-            result.add((node_by_idx[rows[i]], variable, node_by_idx[cols[i]]))
+    for name, (var, _, _) in boxes.items():
+        rows_idx, cols_idx = graph_arrays[name].nonzero()
+        for i, j in zip(rows_idx, cols_idx):
+            result.add((graph.nodes[i], var, graph.nodes[j]))
     return result
 
 
-RPQMethods = Enum("Method", ["Hellings", "Matrix"])
-RPQMethodsFunc = {RPQMethods.Hellings: hellings_rpq, RPQMethods.Matrix: matrix_rpq}
+RPQMethods = Enum("Method", ["Hellings", "Matrix", "Tensor"])
+RPQMethodsFunc = {
+    RPQMethods.Hellings: hellings_rpq,
+    RPQMethods.Matrix: matrix_rpq,
+    RPQMethods.Tensor: tensor_rpq,
+}
 
 
-def all_pairs_rpq(method: RPQMethods, graph: MultiDiGraph, cfg: CFG) -> Set[Tuple]:
+def all_pairs_rpq(
+    method: RPQMethods, graph: Union[MultiDiGraph, LabeledGraph], cfg: CFG
+) -> Set[Tuple]:
     """
     Solve the reachability problem between all pairs of vertices
     for a given graph `graph`<V, E, L> and a given CF<N, E, P, S> grammar `cfq`.
@@ -161,9 +567,9 @@ def all_pairs_rpq(method: RPQMethods, graph: MultiDiGraph, cfg: CFG) -> Set[Tupl
     ----------
     method: RPQMethods
         Algorithm that used for solve rpq
-    graph : `~networkx.MultiDiGraph`
+    graph : `~networkx.MultiDiGraph` or `LabeledGraph`
         A source database
-    cfq : ~`pyformlang.cfg import CFG`
+    cfq : ~`pyformlang.cfg import CFG` or `CompiledGrammar`
         Context-free grammar that defines constraints
 
     Returns
@@ -178,8 +584,8 @@ def all_pairs_rpq(method: RPQMethods, graph: MultiDiGraph, cfg: CFG) -> Set[Tupl
 
 def rpq(
     method: RPQMethods,
-    graph: MultiDiGraph,
-    cfg: CFG,
+    graph: Union[MultiDiGraph, LabeledGraph],
+    cfg: Union[CFG, CompiledGrammar],
     non_term: str = None,
     start_v=None,
     final_v=None,
@@ -187,14 +593,16 @@ def rpq(
     """
     Solve the reachability problem for a given set of starting and final vertices,
     and a given non terminal `N`.
+    The evaluation is restricted to the subgraph of vertices that lie on paths
+    from the starting to the final vertices and to the productions derivable from `N`.
 
     Parameters
     ----------
     method: RPQMethods
         Algorithm that used for solve rpq
-    graph : `~networkx.MultiDiGraph`
+    graph : `~networkx.MultiDiGraph` or `LabeledGraph`
         A source database
-    cfq : ~`yformlang.cfg import CFG`
+    cfq : ~`yformlang.cfg import CFG` or `CompiledGrammar`
         Context-free grammar that defines constraints
     non_term: str
         View of a non terminal
@@ -210,12 +618,22 @@ def rpq(
         * non_terminal of the cfg
         * final vertex
     """
-    if start_v is None:
-        start_v = graph.nodes()
-    if final_v is None:
-        final_v = graph.nodes()
-
-    all_pairs = all_pairs_rpq(method, graph, cfg)
+    graph = as_labeled_graph(graph)
+    start_v = set(graph.nodes) if start_v is None else set(start_v)
+    final_v = set(graph.nodes) if final_v is None else set(final_v)
+    if non_term is not None:
+        # nonterminals that are not derivable from `non_term` are removed
+        # as useless symbols on the conversion to WCNF
+        non_term = non_term if isinstance(non_term, Variable) else Variable(non_term)
+        if isinstance(cfg, CompiledGrammar):
+            cfg = cfg.to_cfg()
+        cfg = CFG(start_symbol=non_term, productions=cfg.productions)
+
+    # only vertices on paths from start to final vertices can take part in the answer
+    footprint = graph.reachable(graph.ids_of(start_v)) & graph.reachable(
+        graph.ids_of(final_v), reverse=True
+    )
+    all_pairs = all_pairs_rpq(method, graph.subgraph(np.flatnonzero(footprint)), cfg)
 
     return {
         (v, N, u)
@@ -248,12 +666,12 @@ def all_pair_rpq_from_file(
         * final vertex
     """
     graph = load_graph_from_file(path_to_graph)
-    cfg = wcnf_from_file(path_to_cfg)
+    cfg = compiled_grammar_from_file(path_to_cfg)
     return all_pairs_rpq(method, graph, cfg)
 
 
 def all_pair_rpq_text(
-    method: RPQMethods, graph: MultiDiGraph, cfg_text: str
+    method: RPQMethods, graph: Union[MultiDiGraph, LabeledGraph], cfg_text: str
 ) -> Set[Tuple]:
     """
     Solve the reachability problem between all pairs of vertices
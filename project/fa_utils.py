@@ -7,10 +7,23 @@ from pyformlang.finite_automaton import (
     NondeterministicFiniteAutomaton,
 )
 from networkx import MultiDiGraph
-from pyformlang.finite_automaton import EpsilonNFA, State
-from collections import namedtuple
+from pyformlang.finite_automaton import EpsilonNFA, State, Symbol, Epsilon
+from collections import namedtuple, defaultdict, OrderedDict
+from collections.abc import Sequence
+from functools import reduce
+from typing import Dict, Union
+import numpy as np
 from scipy import sparse
 from scipy.sparse import csc_array as array_type
+from project.parallel import matmul
+from project.backends import (
+    BitMatrix,
+    MatrixBackend,
+    adapt,
+    get_backend,
+    masked_matmul,
+    to_backend,
+)
 
 
 def build_minimal_dfa_from_regex(reg: Regex) -> DeterministicFiniteAutomaton:
@@ -87,15 +100,44 @@ def build_nfa_from_graph(
 BooleanDecomposition = namedtuple("BooleanDecomposition", ["arrays", "idx", "states"])
 
 
-def boolean_decomposition(f_auto: EpsilonNFA) -> BooleanDecomposition:
+def epsilon_free(f_auto: EpsilonNFA) -> EpsilonNFA:
+    """
+    Returns an automaton equivalent to `f_auto` without epsilon transitions.
+    Automata that have no epsilon transitions are returned as is,
+    so the costly removal runs only when it is really needed.
+
+    Parameters
+    ----------
+    f_auto: `~pyformlang.finite_automaton.EpsilonNFA`
+
+    Returns
+    -------
+    f_auto: `~pyformlang.finite_automaton.EpsilonNFA`
+        The automaton without epsilon transitions
+    """
+    if isinstance(f_auto, NondeterministicFiniteAutomaton):
+        return f_auto
+    if any(isinstance(symb, Epsilon) for _, symb, _ in f_auto):
+        return f_auto.remove_epsilon_transitions()
+    return f_auto
+
+
+def boolean_decomposition(
+    f_auto: EpsilonNFA, backend: Union[str, MatrixBackend] = None
+) -> BooleanDecomposition:
     """
     Represents an automaton in the form of a dictionary,
     where the key is the symbol x,
     the value is a matrix with transitions only on x.
+    The indexes of the transitions are collected in one pass
+    and every matrix is built at once.
 
     Parameters
     ----------
     f_auto: `~pyformlang.finite_automaton.EpsilonNFA`
+    backend: str or `~project.backends.MatrixBackend` or None
+        Storage of the matrices: "sparse" (default), "bitset" or "auto"
+        to pack the dense matrices into bitsets
 
     Returns
     -------
@@ -105,21 +147,207 @@ def boolean_decomposition(f_auto: EpsilonNFA) -> BooleanDecomposition:
     `idx` - list with States of graph (fixed indexes)
     `states` - dictionary with State and their index in matrix
     """
-    f_auto = f_auto.remove_epsilon_transitions()
+    f_auto = epsilon_free(f_auto)
     states = list(f_auto.states)
-    idxs = dict()
-    for i in range(len(states)):
-        idxs[states[i]] = i
+    idxs = {state: i for i, state in enumerate(states)}
+    rows = defaultdict(list)
+    cols = defaultdict(list)
+    for from_, symb, to in f_auto:
+        rows[symb].append(idxs[from_])
+        cols[symb].append(idxs[to])
+    storage = get_backend(None if backend == "auto" else backend)
     arrays = {
-        symbol: array_type((len(states), len(states)), dtype=bool)
+        symbol: adapt(
+            storage.from_coo(rows[symbol], cols[symbol], (len(states), len(states))),
+            backend,
+        )
         for symbol in f_auto.symbols
     }
-    for from_, symb, to in f_auto:
-        arrays[symb][idxs[from_], idxs[to]] = True
     return BooleanDecomposition(arrays, idxs, states)
 
 
-def intersection(fa1: EpsilonNFA, fa2: EpsilonNFA) -> EpsilonNFA:
+class _ProductStates(Sequence):
+    """
+    States of the product of two automata, the state with id `i * len(right) + j`
+    is `State((left[i], right[j]))`. The states are created only on access.
+    """
+
+    def __init__(self, left: Sequence, right: Sequence):
+        self._left = left
+        self._right = right
+
+    def __len__(self):
+        return len(self._left) * len(self._right)
+
+    def __getitem__(self, i):
+        left, right = divmod(i, len(self._right))
+        return State((self._left[left], self._right[right]))
+
+
+class MatrixAutomaton:
+    """
+    Representation of a finite automaton without epsilon transitions
+    by boolean matrices over integer state ids
+    """
+
+    def __init__(
+        self,
+        arrays: Dict[Symbol, array_type],
+        states: Sequence,
+        start_idx: np.ndarray,
+        final_idx: np.ndarray,
+        adjacency: array_type = None,
+    ):
+        """
+        Initializes an instance of the MatrixAutomaton class.
+
+        Parameters
+        ----------
+        arrays : dict of Symbol and `array_type`
+            Boolean matrices of the transitions by each symbol
+        states : sequence of pyformlang.finite_automaton.State
+            The state of every id
+        start_idx : numpy.ndarray
+            Ids of the start states
+        final_idx : numpy.ndarray
+            Ids of the final states
+        adjacency : `array_type`, optional
+            Boolean matrix of the transitions by any symbol.
+            If not specified, it is the sum of `arrays`.
+        """
+        self.arrays = arrays
+        self.states = states
+        self.start_idx = start_idx
+        self.final_idx = final_idx
+        self._adjacency = adjacency
+
+    @staticmethod
+    def from_fa(f_auto: EpsilonNFA) -> "MatrixAutomaton":
+        """
+        Constructs a MatrixAutomaton from a pyformlang automaton.
+
+        Parameters
+        ----------
+        f_auto: `~pyformlang.finite_automaton.EpsilonNFA`
+
+        Returns
+        -------
+        MatrixAutomaton
+            An automaton with the boolean decomposition of `f_auto`
+        """
+        f_auto = epsilon_free(f_auto)
+        arrays, idxs, states = boolean_decomposition(f_auto)
+        return MatrixAutomaton(
+            arrays,
+            states,
+            np.array([idxs[st] for st in f_auto.start_states], dtype=int),
+            np.array([idxs[st] for st in f_auto.final_states], dtype=int),
+        )
+
+    def __len__(self):
+        return len(self.states)
+
+    def adjacency(self) -> array_type:
+        """
+        Returns the boolean matrix of the transitions by any symbol.
+        """
+        if self._adjacency is None:
+            self._adjacency = reduce(
+                lambda a, b: a + b,
+                self.arrays.values(),
+                array_type((len(self), len(self)), dtype=bool),
+            )
+        return self._adjacency
+
+    def to_epsilon_nfa(self) -> EpsilonNFA:
+        """
+        Exports the automaton to a pyformlang automaton.
+
+        Returns
+        -------
+        f_auto: `~pyformlang.finite_automaton.EpsilonNFA`
+            The automaton with the same states and transitions
+        """
+        f_auto = EpsilonNFA()
+        for i in self.start_idx:
+            f_auto.add_start_state(self.states[i])
+        for i in self.final_idx:
+            f_auto.add_final_state(self.states[i])
+        for symb, array in self.arrays.items():
+            from_idx, to_idx = array.nonzero()
+            for i, j in zip(from_idx, to_idx):
+                f_auto.add_transition(self.states[i], symb, self.states[j])
+        return f_auto
+
+
+def matrix_intersection(
+    fa1: Union[EpsilonNFA, MatrixAutomaton],
+    fa2: Union[EpsilonNFA, MatrixAutomaton],
+    reachability_only: bool = False,
+    backend: Union[str, MatrixBackend] = None,
+) -> MatrixAutomaton:
+    """Computes the intersection of two finite automata
+    using the tensor product of the boolean decomposition of automata.
+    The state with id `i * len(fa2) + j` is the pair of `i`-th state of `fa1`
+    and `j`-th state of `fa2`.
+
+    Parameters
+    ----------
+    fa1: `~pyformlang.finite_automaton.EpsilonNFA` or `MatrixAutomaton`
+        First finite automation, located on the left in the product
+    fa2: `~pyformlang.finite_automaton.EpsilonNFA` or `MatrixAutomaton`
+        Second finite automation, located on the right in the product
+    reachability_only: bool
+        If True, only the sum of the products by all symbols is built
+        and the result has no matrices by symbols
+    backend: str or `~project.backends.MatrixBackend` or None
+        Storage of the resulting matrices: "sparse", "bitset" or "auto"
+        to pack the dense matrices into bitsets, by default the products are sparse
+
+    Returns
+    -------
+    fa3: `MatrixAutomaton`
+        The intersection of the two automata
+    """
+    if not isinstance(fa1, MatrixAutomaton):
+        fa1 = MatrixAutomaton.from_fa(fa1)
+    if not isinstance(fa2, MatrixAutomaton):
+        fa2 = MatrixAutomaton.from_fa(fa2)
+    len2 = len(fa2)
+    as_sparse = get_backend("sparse").convert
+    products = (
+        (
+            symb,
+            sparse.kron(
+                as_sparse(fa1.arrays[symb]), as_sparse(fa2.arrays[symb]), format="csc"
+            ),
+        )
+        for symb in fa1.arrays.keys() & fa2.arrays.keys()
+    )
+    arrays, adjacency = dict(), None
+    if reachability_only:
+        adjacency = reduce(
+            lambda a, b: a + b,
+            (product for _, product in products),
+            array_type((len(fa1) * len2, len(fa1) * len2), dtype=bool),
+        )
+        adjacency = to_backend(adjacency, backend)
+    else:
+        arrays = {symb: to_backend(product, backend) for symb, product in products}
+    start_idx = (fa1.start_idx[:, None] * len2 + fa2.start_idx[None, :]).ravel()
+    final_idx = (fa1.final_idx[:, None] * len2 + fa2.final_idx[None, :]).ravel()
+    return MatrixAutomaton(
+        arrays,
+        _ProductStates(fa1.states, fa2.states),
+        start_idx,
+        final_idx,
+        adjacency,
+    )
+
+
+def intersection(
+    fa1: EpsilonNFA, fa2: EpsilonNFA, backend: Union[str, MatrixBackend] = None
+) -> EpsilonNFA:
     """Computes the intersection of two finite automata
     using the tensor product of the boolean decomposition of automata.
 
@@ -129,35 +357,208 @@ def intersection(fa1: EpsilonNFA, fa2: EpsilonNFA) -> EpsilonNFA:
         First finite automation, located on the left in the product
     fa2: `~pyformlang.finite_automaton.EpsilonNFA`
         Second finite automation, located on the right in the product
+    backend: str or `~project.backends.MatrixBackend` or None
+        Storage of the product matrices: "sparse" (default), "bitset" or "auto"
 
     Returns
     -------
     fa3: `~pyformlang.finite_automaton.EpsilonNFA`
         The intersection of the two Epsilon NFAs
     """
-    arrays1, idxs1, states1 = boolean_decomposition(fa1)
-    arrays2, idxs2, states2 = boolean_decomposition(fa2)
-    len1 = len(states1)
-    len2 = len(states2)
-    symbols3 = fa1.symbols.intersection(fa2.symbols)
-    states3 = [None] * (len1 * len2)
-    for i in range(len1):
-        for j in range(len2):
-            states3[i * len2 + j] = State((states1[i], states2[j]))
-    fa3 = EpsilonNFA()
-
-    for i in fa1.final_states:
-        for j in fa2.final_states:
-            fa3.add_final_state(states3[idxs1[i] * len2 + idxs2[j]])
-
-    for i in fa1.start_states:
-        for j in fa2.start_states:
-            fa3.add_start_state(states3[idxs1[i] * len2 + idxs2[j]])
-
-    for symb in symbols3:
-        bool_array = sparse.kron(arrays1[symb], arrays2[symb])
-        from_idx, to_idx = bool_array.nonzero()
-        for i in range(len(to_idx)):
-            fa3.add_transition(states3[from_idx[i]], symb, states3[to_idx[i]])
-
-    return fa3
+    return matrix_intersection(fa1, fa2, backend=backend).to_epsilon_nfa()
+
+
+def transitive_closure(
+    edges: array_type,
+    closure: array_type = None,
+    workers: int = 1,
+    backend: Union[str, MatrixBackend] = None,
+) -> array_type:
+    """
+    Computes the transitive closure of the boolean adjacency matrix `edges`,
+    or extends the already transitively closed matrix `closure` with new `edges`.
+    On every step only the newly discovered reachability entries
+    are multiplied against the adjacency with the known entries masked out,
+    and the loop stops when no new entries are found.
+
+    Parameters
+    ----------
+    edges: `array_type`
+        Boolean adjacency matrix
+    closure: `array_type` or None
+        Transitively closed boolean matrix of the same shape, empty by default
+    workers: int
+        Number of processes multiplying the row blocks of the matrices
+    backend: str or `~project.backends.MatrixBackend` or None
+        Storage of the closure: "sparse", "bitset" or "auto" to switch
+        to bitsets when the closure becomes dense, by default the storage of `edges`
+
+    Returns
+    -------
+    closure: `array_type` or `~project.backends.BitMatrix`
+        The transitive closure of `closure` + `edges`
+    """
+    multiply = matmul(workers)
+    edges = to_backend(edges, backend)
+    if closure is None:
+        closure = (
+            BitMatrix.zeros(edges.shape)
+            if isinstance(edges, BitMatrix)
+            else array_type(edges.shape, dtype=bool)
+        )
+    closure = to_backend(closure, backend)
+    base = closure + edges
+    delta = (edges > closure) + masked_matmul(closure, edges, closure, multiply)
+    closure = adapt(closure + delta, backend)
+    while delta.nnz > 0:
+        if isinstance(closure, BitMatrix) and not isinstance(base, BitMatrix):
+            base = BitMatrix.from_sparse(base)
+        delta = masked_matmul(delta, base, closure, multiply)
+        closure = adapt(closure + delta, backend)
+    return closure
+
+
+CompiledQuery = namedtuple("CompiledQuery", ["dfa", "decomposition", "automaton"])
+CacheStats = namedtuple(
+    "CacheStats", ["hits", "misses", "evictions", "entries", "nbytes"]
+)
+
+
+def _query_key(reg: Union[Regex, str]) -> str:
+    """
+    Normalized text of the regular expression: runs of whitespace in a string
+    are collapsed, a Regex object is printed in the pyformlang form.
+    """
+    if isinstance(reg, str):
+        return " ".join(reg.split())
+    return str(reg)
+
+
+def _decomposition_nbytes(decomposition: BooleanDecomposition) -> int:
+    """
+    Approximate memory used by the matrices of the decomposition in bytes.
+    """
+    return sum(
+        array.data.nbytes + array.indices.nbytes + array.indptr.nbytes
+        for array in decomposition.arrays.values()
+    )
+
+
+class QueryCache:
+    """
+    Bounded LRU cache of the minimal DFAs of regular queries
+    and their boolean decompositions.
+    The cached automata are shared between the callers and must not be modified.
+    """
+
+    def __init__(self, max_entries: int = 512, max_bytes: int = 64 << 20):
+        """
+        Initializes an instance of the QueryCache class.
+
+        Parameters
+        ----------
+        max_entries : int
+            Maximum number of the cached queries
+        max_bytes : int
+            Maximum approximate memory of the cached matrices in bytes
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, reg: Union[Regex, str]) -> bool:
+        return _query_key(reg) in self._entries
+
+    def get(self, reg: Union[Regex, str]) -> CompiledQuery:
+        """
+        Returns the compiled query, the query is compiled on a miss.
+
+        Parameters
+        ----------
+        reg: `~pyformlang.regular_expression.Regex` or str
+            Regular expression object or its text
+
+        Returns
+        -------
+        query: `CompiledQuery`
+            The named tuple with the minimal DFA of the query,
+            its `BooleanDecomposition` and the `MatrixAutomaton` built from it
+        """
+        key = _query_key(reg)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+        self.misses += 1
+        query = _compile_query(Regex(reg) if isinstance(reg, str) else reg)
+        nbytes = _decomposition_nbytes(query.decomposition)
+        if nbytes <= self.max_bytes and self.max_entries > 0:
+            self._entries[key] = (query, nbytes)
+            self._nbytes += nbytes
+            self._evict()
+        return query
+
+    def stats(self) -> CacheStats:
+        """
+        Returns the hit, miss and eviction counters with the current size of the cache.
+        """
+        return CacheStats(
+            self.hits, self.misses, self.evictions, len(self._entries), self._nbytes
+        )
+
+    def clear(self):
+        """
+        Removes all the entries and resets the counters.
+        """
+        self._entries.clear()
+        self._nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries or self._nbytes > self.max_bytes:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self._nbytes -= nbytes
+            self.evictions += 1
+
+
+def _compile_query(reg: Regex) -> CompiledQuery:
+    dfa = build_minimal_dfa_from_regex(reg)
+    decomposition = boolean_decomposition(dfa)
+    automaton = MatrixAutomaton(
+        decomposition.arrays,
+        decomposition.states,
+        np.array([decomposition.idx[st] for st in dfa.start_states], dtype=int),
+        np.array([decomposition.idx[st] for st in dfa.final_states], dtype=int),
+    )
+    return CompiledQuery(dfa, decomposition, automaton)
+
+
+QUERY_CACHE = QueryCache()
+
+
+def compile_query(reg: Union[Regex, str], cache: QueryCache = None) -> CompiledQuery:
+    """
+    Returns the minimal DFA of the regular expression with its boolean decomposition
+    from the LRU cache of the compiled queries.
+
+    Parameters
+    ----------
+    reg: `~pyformlang.regular_expression.Regex` or str
+        Regular expression object or its text
+    cache: `QueryCache` or None
+        The cache to use, the module-level `QUERY_CACHE` by default
+
+    Returns
+    -------
+    query: `CompiledQuery`
+        The compiled query, its automata must not be modified
+    """
+    return (QUERY_CACHE if cache is None else cache).get(reg)
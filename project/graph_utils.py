@@ -1,21 +1,51 @@
 import cfpq_data as cd
 from networkx import MultiDiGraph
 from networkx.drawing.nx_pydot import write_dot, read_dot
-from collections import namedtuple
+from collections import namedtuple, defaultdict
+from array import array
+from itertools import islice
+from pathlib import Path
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import Any, Dict, Iterable, List, Set, Tuple, Union
+import numpy as np
+from scipy import sparse
+from pyformlang.finite_automaton import State
+from project.fa_utils import MatrixAutomaton, array_type
 
 GraphInfo = namedtuple("GraphInfo", ["number_of_edges", "number_of_nodes", "labels"])
 
 
-def load_graph_by_name(name: str) -> MultiDiGraph:
-    path_to_graph = cd.download(name)
-    graph = cd.graph_from_csv(path_to_graph)
-    return graph
+def load_graph_by_name(name: str, registry_dir: str = None) -> MultiDiGraph:
+    """
+    Loads the dataset graph `name` from the local registry,
+    the graph is downloaded and registered only if it is not there.
+    """
+    if name not in read_manifest(registry_dir):
+        path_to_graph = cd.download(name)
+        graph = cd.graph_from_csv(path_to_graph)
+        register_graph(name, graph, registry_dir)
+        return graph
+    return load_labeled_graph_by_name(name, registry_dir).to_networkx()
 
 
-def graph_info_by_name(name: str) -> GraphInfo:
-    graph = load_graph_by_name(name)
+def graph_info_by_name(name: str, registry_dir: str = None) -> GraphInfo:
+    """
+    Returns the metadata of the dataset graph `name` from the registry manifest
+    without loading the graph.
+    """
+    manifest = read_manifest(registry_dir)
+    if name not in manifest:
+        load_graph_by_name(name, registry_dir)
+        manifest = read_manifest(registry_dir)
+    info = manifest[name]
     return GraphInfo(
-        graph.number_of_edges(), graph.number_of_nodes(), unique_labels(graph)
+        info["number_of_edges"], info["number_of_nodes"], set(info["labels"])
     )
 
 
@@ -38,3 +68,457 @@ def generate_two_cycles_graph(
 
 def load_graph_from_file(path: str) -> MultiDiGraph:
     return read_dot(path)
+
+
+class LabeledGraph:
+    """
+    Compact representation of an edge-labeled graph.
+    Vertices are interned to int32 ids once
+    and every label has its own boolean adjacency matrix in CSR format.
+    """
+
+    def __init__(self, nodes: List, arrays: Dict[Any, sparse.csr_array]):
+        """
+        Initializes an instance of the LabeledGraph class.
+
+        Parameters
+        ----------
+        nodes : list
+            The original vertex of every id
+        arrays : dict of label and `~scipy.sparse.csr_array`
+            Boolean adjacency matrix of the edges with each label
+        """
+        self.nodes = nodes
+        self.arrays = arrays
+        self._idx = None
+        self._adjacency = None
+
+    @staticmethod
+    def from_index_arrays(
+        nodes: List, edges: Dict[Any, Tuple[Iterable[int], Iterable[int]]]
+    ) -> "LabeledGraph":
+        """
+        Constructs a LabeledGraph from the source and target ids of the edges of every label.
+
+        Parameters
+        ----------
+        nodes : list
+            The original vertex of every id
+        edges : dict of label and pair of iterables
+            The source ids and the target ids of the edges with each label
+
+        Returns
+        -------
+        LabeledGraph
+            The graph with one adjacency matrix per label
+        """
+        n = len(nodes)
+        arrays = dict()
+        for label, (rows, cols) in edges.items():
+            rows = np.asarray(rows, dtype=np.int32)
+            cols = np.asarray(cols, dtype=np.int32)
+            arrays[label] = sparse.csr_array(
+                (np.ones(len(rows), dtype=bool), (rows, cols)), shape=(n, n), dtype=bool
+            )
+        return LabeledGraph(nodes, arrays)
+
+    @staticmethod
+    def from_networkx(graph: MultiDiGraph) -> "LabeledGraph":
+        """
+        Constructs a LabeledGraph from a networkx graph.
+        The edges without a label are skipped.
+
+        Parameters
+        ----------
+        graph : `~networkx.MultiDiGraph`
+            The graph with edge attribute `label`
+
+        Returns
+        -------
+        LabeledGraph
+            The graph with one adjacency matrix per label
+        """
+        nodes = list(graph.nodes())
+        idx = {v: i for i, v in enumerate(nodes)}
+        edges = defaultdict(lambda: (array("i"), array("i")))
+        for frm, to, label in graph.edges(data="label"):
+            if label is None:
+                continue
+            rows, cols = edges[label]
+            rows.append(idx[frm])
+            cols.append(idx[to])
+        return LabeledGraph.from_index_arrays(nodes, edges)
+
+    @property
+    def idx(self) -> Dict[Any, int]:
+        """Dictionary with the original vertex and its id"""
+        if self._idx is None:
+            self._idx = {v: i for i, v in enumerate(self.nodes)}
+        return self._idx
+
+    def number_of_nodes(self) -> int:
+        return len(self.nodes)
+
+    def number_of_edges(self) -> int:
+        """Number of the edges, the parallel edges with the same label are counted once"""
+        return sum(matrix.nnz for matrix in self.arrays.values())
+
+    def labels(self) -> Set:
+        return set(self.arrays.keys())
+
+    def label_stats(self) -> Dict[Any, int]:
+        """Dictionary with the label and the number of edges with it"""
+        return {label: matrix.nnz for label, matrix in self.arrays.items()}
+
+    def adjacency(self) -> sparse.csr_array:
+        """Boolean adjacency matrix of the edges with any label"""
+        if self._adjacency is None:
+            n = self.number_of_nodes()
+            self._adjacency = sparse.csr_array((n, n), dtype=bool)
+            for matrix in self.arrays.values():
+                self._adjacency = self._adjacency + matrix
+        return self._adjacency
+
+    def reachable(self, sources: Iterable[int], reverse: bool = False) -> np.ndarray:
+        """
+        Returns the boolean mask of ids reachable from the `sources` ids
+        (including themselves) by the edges with any label.
+        If `reverse` is True, the edges are followed backwards.
+        """
+        adjacency = self.adjacency()
+        if reverse:
+            adjacency = sparse.csr_array(adjacency.T)
+        visited = np.zeros(self.number_of_nodes(), dtype=bool)
+        front = np.unique(np.asarray(list(sources), dtype=np.int32))
+        visited[front] = True
+        while front.size > 0:
+            front = np.unique(adjacency[front].indices)
+            front = front[~visited[front]]
+            visited[front] = True
+        return visited
+
+    def subgraph(self, ids: Iterable[int]) -> "LabeledGraph":
+        """Returns the subgraph induced by the vertices with `ids`"""
+        ids = np.asarray(list(ids), dtype=np.int32)
+        return LabeledGraph(
+            [self.nodes[i] for i in ids],
+            {
+                label: sparse.csr_array(matrix[ids][:, ids])
+                for label, matrix in self.arrays.items()
+            },
+        )
+
+    def to_matrix_automaton(self, start_states=None, final_states=None):
+        """
+        Represents the graph as a finite automaton with vertex states.
+
+        Parameters
+        ----------
+        start_states: iterable or None
+            Nodes in the graph that will be marked as the initial states of the automaton. If None, all vertices are marked.
+        final_states: iterable or None
+            Nodes in the graph that will be marked as the final states of the automaton. If None, all vertices are marked.
+
+        Returns
+        -------
+        f_auto: `~project.fa_utils.MatrixAutomaton`
+            The automaton with the adjacency matrices of the graph
+        """
+        all_ids = np.arange(self.number_of_nodes())
+        return MatrixAutomaton(
+            {label: array_type(matrix) for label, matrix in self.arrays.items()},
+            [State(v) for v in self.nodes],
+            all_ids if start_states is None else self.ids_of(start_states),
+            all_ids if final_states is None else self.ids_of(final_states),
+        )
+
+    def ids_of(self, nodes: Iterable) -> np.ndarray:
+        """Returns the ids of the given `nodes`, the nodes not in the graph are skipped"""
+        idx = self.idx
+        return np.array([idx[v] for v in nodes if v in idx], dtype=np.int32)
+
+    def to_networkx(self) -> MultiDiGraph:
+        nodes = self.nodes
+        if isinstance(nodes, np.ndarray):
+            nodes = nodes.tolist()
+        graph = MultiDiGraph()
+        graph.add_nodes_from(nodes)
+        for label, matrix in self.arrays.items():
+            frm, to = matrix.nonzero()
+            graph.add_edges_from(
+                (nodes[i], nodes[j], {"label": label}) for i, j in zip(frm, to)
+            )
+        return graph
+
+
+def as_labeled_graph(graph: Union[MultiDiGraph, LabeledGraph]) -> LabeledGraph:
+    """
+    Returns `graph` as a LabeledGraph, a networkx graph is converted.
+    """
+    if isinstance(graph, LabeledGraph):
+        return graph
+    return LabeledGraph.from_networkx(graph)
+
+
+GRAPH_CACHE_DIR = Path.home() / ".cache" / "formal-lang-course" / "graphs"
+GRAPH_REGISTRY_DIR = Path(
+    os.environ.get(
+        "GRAPH_REGISTRY_DIR", Path.home() / ".cache" / "formal-lang-course" / "registry"
+    )
+)
+MANIFEST = "manifest.json"
+
+
+def save_labeled_graph(graph: LabeledGraph, path: str) -> None:
+    """
+    Saves `graph` into the directory `path` as `.npy` arrays:
+    the vertex dictionary, the labels and the CSR arrays of every label.
+    The directory is written next to `path` first and then renamed,
+    so readers never see a partially written graph.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(dir=path.parent, prefix=f".{path.name}."))
+    labels = list(graph.arrays.keys())
+    np.save(tmp / "nodes.npy", np.asarray(graph.nodes), allow_pickle=True)
+    np.save(tmp / "labels.npy", np.asarray(labels), allow_pickle=True)
+    for i, label in enumerate(labels):
+        matrix = graph.arrays[label]
+        np.save(tmp / f"indptr_{i}.npy", matrix.indptr)
+        np.save(tmp / f"indices_{i}.npy", matrix.indices)
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        # the graph has been saved by another process
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def load_labeled_graph(path: str, mmap: bool = True) -> LabeledGraph:
+    """
+    Loads a graph saved by `save_labeled_graph` from the directory `path`.
+    If `mmap` is True, the arrays are memory-mapped in read-only mode,
+    so several processes share the same pages.
+    """
+    path = Path(path)
+    mmap_mode = "r" if mmap else None
+
+    def load(name):
+        try:
+            return np.load(path / name, mmap_mode=mmap_mode)
+        except ValueError:
+            # object arrays can not be memory-mapped
+            return np.load(path / name, allow_pickle=True)
+
+    nodes = load("nodes.npy")
+    labels = load("labels.npy").tolist()
+    n = len(nodes)
+    arrays = dict()
+    for i, label in enumerate(labels):
+        indices = load(f"indices_{i}.npy")
+        arrays[label] = sparse.csr_array(
+            (np.ones(len(indices), dtype=bool), indices, load(f"indptr_{i}.npy")),
+            shape=(n, n),
+        )
+    return LabeledGraph(nodes, arrays)
+
+
+def file_hash(path: str) -> str:
+    """Returns the sha256 hash of the content of the file `path`"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as src:
+        for chunk in iter(lambda: src.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_cached_graph_from_file(path: str, cache_dir: str = None) -> LabeledGraph:
+    """
+    Loads a DOT graph from the file `path` as a LabeledGraph.
+    The graph is converted only on the first call and stored in `cache_dir`
+    under the hash of the file content, later calls memory-map the stored arrays.
+
+    Parameters
+    ----------
+    path: str
+        Path to a DOT file
+    cache_dir: str or None
+        Directory with the converted graphs, `GRAPH_CACHE_DIR` by default
+
+    Returns
+    -------
+    graph: `LabeledGraph`
+        The graph with memory-mapped arrays
+    """
+    cached = Path(cache_dir or GRAPH_CACHE_DIR) / file_hash(path)
+    if not cached.exists():
+        save_labeled_graph(
+            LabeledGraph.from_networkx(load_graph_from_file(path)), cached
+        )
+    return load_labeled_graph(cached)
+
+
+LoadStats = namedtuple("LoadStats", ["number_of_edges", "seconds", "edges_per_second"])
+
+
+def _open_text(path: str):
+    """Opens a plain or gzip-compressed text file"""
+    with open(path, "rb") as src:
+        is_gzip = src.read(2) == b"\x1f\x8b"
+    if is_gzip:
+        return gzip.open(path, "rt")
+    return open(path, "r")
+
+
+def stream_graph_from_edge_list(
+    path: str,
+    order: Tuple[str, str, str] = ("src", "label", "dst"),
+    sep: str = None,
+    chunk_size: int = 1 << 16,
+    node_type=str,
+) -> Tuple[LabeledGraph, LoadStats]:
+    """
+    Loads a graph from an edge list file without building a networkx graph.
+    Vertices and labels are interned while the file is read in chunks of lines
+    and the edge ids are appended to compact per-label buffers,
+    which are turned into the label matrices at the end.
+
+    Parameters
+    ----------
+    path: str
+        Path to a plain or gzip-compressed file with one edge per line
+    order: tuple of str
+        Order of the `src`, `label` and `dst` columns in a line,
+        the CSV files of cfpq_data use ("src", "dst", "label")
+    sep: str or None
+        Column separator, any whitespace by default, "," for CSV files
+    chunk_size: int
+        Number of lines read at once
+    node_type: callable
+        Conversion of the vertex column, e.g. `int`
+
+    Returns
+    -------
+    graph: `LabeledGraph`
+        The loaded graph
+    stats: `LoadStats`
+        The number of read edges, the loading time and the throughput
+    """
+    src_col, label_col, dst_col = (order.index(c) for c in ("src", "label", "dst"))
+    started = time.perf_counter()
+    idx = dict()
+    nodes = []
+    edges = dict()
+    number_of_edges = 0
+
+    def intern(node):
+        i = idx.get(node)
+        if i is None:
+            i = idx[node] = len(nodes)
+            nodes.append(node)
+        return i
+
+    with _open_text(path) as src:
+        while True:
+            lines = list(islice(src, chunk_size))
+            if not lines:
+                break
+            for line in lines:
+                columns = line.strip().split(sep)
+                if len(columns) < 3:
+                    continue
+                label = columns[label_col].strip()
+                buffers = edges.get(label)
+                if buffers is None:
+                    buffers = edges[label] = (array("i"), array("i"))
+                buffers[0].append(intern(node_type(columns[src_col].strip())))
+                buffers[1].append(intern(node_type(columns[dst_col].strip())))
+                number_of_edges += 1
+
+    n = len(nodes)
+    arrays = dict()
+    for label in list(edges):
+        # the buffers are released right after the matrix of the label is built
+        rows, cols = edges.pop(label)
+        rows = np.frombuffer(rows, dtype=np.intc)
+        cols = np.frombuffer(cols, dtype=np.intc)
+        arrays[label] = sparse.csr_array(
+            (np.ones(len(rows), dtype=bool), (rows, cols)), shape=(n, n), dtype=bool
+        )
+    seconds = time.perf_counter() - started
+    stats = LoadStats(
+        number_of_edges, seconds, number_of_edges / seconds if seconds > 0 else 0.0
+    )
+    graph = LabeledGraph(nodes, arrays)
+    graph._idx = idx
+    return graph, stats
+
+
+def read_manifest(registry_dir: str = None) -> Dict[str, Dict]:
+    """
+    Returns the manifest of the registry: dictionary with the name of a graph
+    and its `GraphInfo` fields. A missing registry has an empty manifest.
+    """
+    path = Path(registry_dir or GRAPH_REGISTRY_DIR) / MANIFEST
+    if not path.exists():
+        return dict()
+    with open(path) as src:
+        return json.load(src)
+
+
+def register_graph(
+    name: str, graph: Union[MultiDiGraph, LabeledGraph], registry_dir: str = None
+) -> GraphInfo:
+    """
+    Stores `graph` in the registry under `name` and adds its metadata to the manifest.
+
+    Parameters
+    ----------
+    name: str
+        Name of the graph
+    graph: `~networkx.MultiDiGraph` or `LabeledGraph`
+        The graph to store
+    registry_dir: str or None
+        Registry directory, `GRAPH_REGISTRY_DIR` (or the environment variable
+        of the same name) by default
+
+    Returns
+    -------
+    info: `GraphInfo`
+        The metadata written to the manifest
+    """
+    registry_dir = Path(registry_dir or GRAPH_REGISTRY_DIR)
+    if isinstance(graph, LabeledGraph):
+        info = GraphInfo(
+            graph.number_of_edges(), graph.number_of_nodes(), graph.labels()
+        )
+    else:
+        info = GraphInfo(
+            graph.number_of_edges(), graph.number_of_nodes(), unique_labels(graph)
+        )
+    save_labeled_graph(as_labeled_graph(graph), registry_dir / name)
+
+    manifest = read_manifest(registry_dir)
+    manifest[name] = {
+        "path": name,
+        "number_of_edges": info.number_of_edges,
+        "number_of_nodes": info.number_of_nodes,
+        "labels": sorted(info.labels, key=str),
+    }
+    tmp = registry_dir / f".{MANIFEST}.{os.getpid()}"
+    with open(tmp, "w") as dst:
+        json.dump(manifest, dst, indent=2)
+    os.replace(tmp, registry_dir / MANIFEST)
+    return info
+
+
+def load_labeled_graph_by_name(name: str, registry_dir: str = None) -> LabeledGraph:
+    """
+    Loads the graph `name` from the registry as a memory-mapped LabeledGraph
+    without network access.
+    """
+    manifest = read_manifest(registry_dir)
+    if name not in manifest:
+        raise KeyError(f"Graph {name} is not registered")
+    return load_labeled_graph(
+        Path(registry_dir or GRAPH_REGISTRY_DIR) / manifest[name]["path"]
+    )
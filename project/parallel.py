@@ -0,0 +1,199 @@
+"""
+A module for the multiplication of boolean sparse matrices in a process pool
+"""
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Callable, Dict, Tuple
+import operator
+import numpy as np
+from scipy import sparse
+
+# the products of smaller left matrices are computed in the calling process
+PARALLEL_MIN_NNZ = 1 << 14
+# number of row blocks per worker, several blocks balance uneven rows
+BLOCKS_PER_WORKER = 4
+
+_POOLS: Dict[int, ProcessPoolExecutor] = dict()
+
+
+class SharedMatrix:
+    """
+    CSR arrays of a boolean sparse matrix placed in shared memory,
+    the workers attach to them by name without copying
+    """
+
+    def __init__(self, matrix):
+        """
+        Copies `matrix` into new shared memory blocks.
+
+        Parameters
+        ----------
+        matrix : sparse array or matrix
+            The matrix to share
+        """
+        matrix = sparse.csr_array(matrix)
+        self.shape = matrix.shape
+        self._blocks = []
+        self.arrays = tuple(
+            self._share(array) for array in (matrix.data, matrix.indices, matrix.indptr)
+        )
+
+    def _share(self, array: np.ndarray) -> np.ndarray:
+        block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        self._blocks.append(block)
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        shared[:] = array
+        return shared
+
+    def descriptor(self) -> Tuple:
+        """
+        Returns the picklable description used by `attach` in a worker.
+        """
+        return (
+            self.shape,
+            tuple(
+                (block.name, array.shape, array.dtype.str)
+                for block, array in zip(self._blocks, self.arrays)
+            ),
+        )
+
+    def close(self):
+        """
+        Releases and removes the shared memory blocks.
+        """
+        self.arrays = None
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def attach(descriptor: Tuple):
+    """
+    Attaches to a shared matrix in a worker.
+
+    Returns
+    -------
+    shape, arrays, blocks
+        The shape of the matrix, its CSR `data`, `indices`, `indptr` arrays
+        and the shared memory blocks that must be closed after use
+    """
+    shape, parts = descriptor
+    blocks, arrays = [], []
+    for name, array_shape, dtype in parts:
+        # the pool processes share the resource tracker of the creating process,
+        # so the block is removed only once by `SharedMatrix.close`
+        block = shared_memory.SharedMemory(name=name)
+        blocks.append(block)
+        arrays.append(np.ndarray(array_shape, dtype=np.dtype(dtype), buffer=block.buf))
+    return shape, arrays, blocks
+
+
+def _multiply_rows(left: Tuple, right: Tuple, start: int, stop: int):
+    """
+    Multiplies the rows `start:stop` of the shared matrix `left` by `right`
+    and returns the `indices` and `indptr` of the resulting CSR block.
+    """
+    (_, left_cols), left_arrays, left_blocks = attach(left)
+    right_shape, right_arrays, right_blocks = attach(right)
+    try:
+        data, indices, indptr = left_arrays
+        lo, hi = indptr[start], indptr[stop]
+        rows = sparse.csr_array(
+            (data[lo:hi], indices[lo:hi], indptr[start : stop + 1] - lo),
+            shape=(stop - start, left_cols),
+        )
+        product = sparse.csr_array(
+            rows @ sparse.csr_array(tuple(right_arrays), shape=right_shape)
+        )
+        return product.indices.copy(), product.indptr.copy()
+    finally:
+        # the views of the shared buffers must be released before closing
+        data = indices = indptr = rows = product = None
+        left_arrays = right_arrays = None
+        for block in left_blocks + right_blocks:
+            block.close()
+
+
+def _pool(workers: int) -> ProcessPoolExecutor:
+    """Returns the process pool with `workers` processes, the pools are reused"""
+    if workers not in _POOLS:
+        _POOLS[workers] = ProcessPoolExecutor(workers)
+    return _POOLS[workers]
+
+
+def _row_blocks(indptr: np.ndarray, blocks: int) -> np.ndarray:
+    """Splits the rows into `blocks` ranges with about the same number of entries"""
+    bounds = np.searchsorted(indptr, np.linspace(0, indptr[-1], blocks + 1))
+    bounds[0], bounds[-1] = 0, len(indptr) - 1
+    return np.unique(bounds)
+
+
+def parallel_matmul(left, right, workers: int):
+    """
+    Computes the boolean product `left @ right` splitting `left` into row blocks
+    that are multiplied in a pool of `workers` processes.
+    Both matrices are placed in shared memory, so only the block bounds
+    and the resulting blocks are sent between the processes.
+
+    Parameters
+    ----------
+    left : sparse array
+        Left boolean matrix, other matrices are multiplied in the calling process
+    right : sparse array
+        Right boolean matrix
+    workers : int
+        Number of the worker processes
+
+    Returns
+    -------
+    product : sparse array
+        The product in the format of `left`
+    """
+    if (
+        workers <= 1
+        or not (sparse.issparse(left) and sparse.issparse(right))
+        or left.nnz < PARALLEL_MIN_NNZ
+        or left.shape[0] < 2
+    ):
+        return left @ right
+    with SharedMatrix(left) as shared_left, SharedMatrix(right) as shared_right:
+        bounds = _row_blocks(shared_left.arrays[2], workers * BLOCKS_PER_WORKER)
+        futures = [
+            _pool(workers).submit(
+                _multiply_rows,
+                shared_left.descriptor(),
+                shared_right.descriptor(),
+                int(start),
+                int(stop),
+            )
+            for start, stop in zip(bounds[:-1], bounds[1:])
+        ]
+        parts = [future.result() for future in futures]
+
+    indices = np.concatenate([part_indices for part_indices, _ in parts])
+    offsets = np.cumsum([0] + [len(part_indices) for part_indices, _ in parts[:-1]])
+    indptr = np.concatenate(
+        [[0]] + [ptr[1:] + offset for (_, ptr), offset in zip(parts, offsets)]
+    )
+    product = sparse.csr_array(
+        (np.ones(len(indices), dtype=bool), indices, indptr),
+        shape=(left.shape[0], right.shape[1]),
+    )
+    return product.asformat(left.format)
+
+
+def matmul(workers: int = 1) -> Callable:
+    """
+    Returns the boolean matrix product function for the given number of workers,
+    the plain `@` operator is used for one worker.
+    """
+    if workers is None or workers <= 1:
+        return operator.matmul
+    return lambda left, right: parallel_matmul(left, right, workers)
@@ -1,72 +1,535 @@
 from project import fa_utils as fa
-from pyformlang.finite_automaton import EpsilonNFA
+from pyformlang.finite_automaton import EpsilonNFA, State
+from collections import defaultdict, namedtuple
 from functools import reduce
 from networkx import MultiDiGraph
+from typing import Iterable, List, Set, Tuple, Union
+from project.graph_utils import LabeledGraph, as_labeled_graph
+from project.backends import MatrixBackend, masked_matmul
+from scipy import sparse
+import numpy as np
 
 
 def all_pair_rpq_from_graph(
-    bd_graph: MultiDiGraph, query: fa.Regex, start_states=None, final_states=None
+    bd_graph: Union[MultiDiGraph, LabeledGraph],
+    query: fa.Regex,
+    start_states=None,
+    final_states=None,
+    on_the_fly: bool = False,
+    workers: int = 1,
+    backend: Union[str, MatrixBackend] = None,
 ):
     """Executes a regular query to `bd`. The transitive closure of the intersection of the logical representation
       `bd` and `query` is used.
 
     Parameters
     ----------
-    bd: `networkx.MultiDiGraph`
-        A finite automaton with the specified start and final States
+    bd: `networkx.MultiDiGraph` or `~project.graph_utils.LabeledGraph`
+        A source database
     query: `pyformlang.regular_expression.Regex`
         Query regular expression
     start_states: iterable
         Numbers of nodes in the graph that will be marked as the initial states of the automaton. By default, all vertices are marked.
     final_states: iterable
         Numbers of nodes in the graph that will be marked as the final states of the automaton. By default, all vertices are marked.
+    on_the_fly: bool
+        If True, the pairs of vertices and query states are explored lazily
+        from every start vertex without building the product of the automata,
+        so the memory is bounded by the visited pairs.
+    workers: int
+        Number of processes multiplying the row blocks of the matrices
+    backend: str or `~project.backends.MatrixBackend` or None
+        Storage of the closure: "sparse" (default), "bitset" or "auto"
+        to switch to bitsets when the closure becomes dense
 
     Returns
     -------
     result: Set[`pyformlang.finite_automaton.State`, `pyformlang.finite_automaton.State`]
         Unique pairs of start and final States of `bd` that are connected by a path from `query`.
     """
-    fa_bd = fa.build_nfa_from_graph(bd_graph, start_states, final_states)
-    return start_final_states_rpq(fa_bd, query)
+    graph = as_labeled_graph(bd_graph)
+    if on_the_fly:
+        return _on_the_fly_rpq(graph, query, start_states, final_states)
+    fa_bd = graph.to_matrix_automaton(start_states, final_states)
+    return start_final_states_rpq(fa_bd, query, workers, backend)
+
 
+def _on_the_fly_rpq(graph: LabeledGraph, query: fa.Regex, start_states, final_states):
+    """Traverses the pairs (vertex, query DFA state) reachable from every start vertex
+    using the per-label adjacency of the graph and the DFA transition table.
+    """
+    dfa = fa.compile_query(query).dfa
+    if dfa.start_state is None:
+        return set()
+    table = dfa.to_dict()
+    dfa_finals = dfa.final_states
+    n = graph.number_of_nodes()
+    starts = range(n) if start_states is None else graph.ids_of(start_states).tolist()
+    finals = np.ones(n, dtype=bool)
+    if final_states is not None:
+        finals[:] = False
+        finals[graph.ids_of(final_states)] = True
 
-def start_final_states_rpq(bd: EpsilonNFA, query: fa.Regex):
+    result = set()
+    for start in starts:
+        visited = set()
+        stack = [(start, dfa.start_state)]
+        while stack:
+            v, q = stack.pop()
+            for label, to in table.get(q, {}).items():
+                array = graph.arrays.get(label)
+                if array is None:
+                    continue
+                for u in array.indices[array.indptr[v] : array.indptr[v + 1]].tolist():
+                    if (u, to) in visited:
+                        continue
+                    visited.add((u, to))
+                    stack.append((u, to))
+                    if to in dfa_finals and finals[u]:
+                        result.add((State(graph.nodes[start]), State(graph.nodes[u])))
+    return result
+
+
+def start_final_states_rpq(
+    bd: Union[EpsilonNFA, fa.MatrixAutomaton],
+    query: fa.Regex,
+    workers: int = 1,
+    backend: Union[str, MatrixBackend] = None,
+):
     """Executes a regular query to `bd`. The transitive closure of the intersection
     of the logical representation `bd` and `query` is used.
 
     Parameters
     ----------
-    bd: `~pyformlang.finite_automaton.EpsilonNFA`
+    bd: `~pyformlang.finite_automaton.EpsilonNFA` or `~project.fa_utils.MatrixAutomaton`
         A finite automaton with the specified start and final States
     query: `pyformlang.regular_expression.Regex`
         Query regular expression
+    workers: int
+        Number of processes multiplying the row blocks of the matrices
+    backend: str or `~project.backends.MatrixBackend` or None
+        Storage of the closure: "sparse" (default), "bitset" or "auto"
+        to switch to bitsets when the closure becomes dense
 
     Returns
     -------
     result: Set[`pyformlang.finite_automaton.State`, `pyformlang.finite_automaton.State`]
         Unique pairs of start and final States of `bd` that are connected by a path from `query`.
     """
-    intersect = fa.intersection(bd, fa.build_minimal_dfa_from_regex(query))
-    arrays, _, states = fa.boolean_decomposition(intersect)
-    array: fa.array_type = reduce(
-        lambda a, b: a + b,
-        arrays.values(),
-        fa.array_type((len(states), len(states)), dtype=bool),
+    intersect = fa.matrix_intersection(
+        bd, fa.compile_query(query).automaton, reachability_only=True
+    )
+    trans_closure = fa.transitive_closure(
+        intersect.adjacency(), workers=workers, backend=backend
+    )
+
+    result = set()
+    finals = set(intersect.final_idx)
+    for start in intersect.start_idx:
+        _, to_idx = trans_closure[[start], :].nonzero()
+        for i in to_idx:
+            if i in finals:
+                result.add(
+                    (intersect.states[start].value[0], intersect.states[i].value[0])
+                )
+    return result
+
+
+def _stack_queries(queries: List[fa.Regex]):
+    """
+    Joins the minimal DFAs of `queries` into one block-diagonal automaton,
+    the states of the `i`-th query have ids starting from `offsets[i]`.
+    """
+    automata = [fa.compile_query(query).automaton for query in queries]
+    offsets = np.cumsum([0] + [len(automaton) for automaton in automata])
+    k = int(offsets[-1])
+    rows = defaultdict(list)
+    cols = defaultdict(list)
+    for offset, automaton in zip(offsets, automata):
+        for symb, array in automaton.arrays.items():
+            frm, to = array.nonzero()
+            rows[symb].append(offset + frm)
+            cols[symb].append(offset + to)
+    arrays = dict()
+    for symb in rows:
+        frm, to = np.concatenate(rows[symb]), np.concatenate(cols[symb])
+        arrays[symb] = fa.array_type(
+            (np.ones(len(frm), dtype=bool), (frm, to)), shape=(k, k), dtype=bool
+        )
+    stacked = fa.MatrixAutomaton(
+        arrays,
+        [State((i, st)) for i, a in enumerate(automata) for st in a.states],
+        np.concatenate([off + a.start_idx for off, a in zip(offsets, automata)]),
+        np.concatenate([off + a.final_idx for off, a in zip(offsets, automata)]),
     )
+    return stacked, automata, offsets
+
 
-    trans_closure = array + array @ array
-    a = array.count_nonzero()
-    b = trans_closure.count_nonzero()
-    while array.count_nonzero() != trans_closure.count_nonzero():
-        array = trans_closure
-        trans_closure = array + array @ array
+def batch_rpq(
+    bd_graph: Union[MultiDiGraph, LabeledGraph],
+    queries: Iterable[fa.Regex],
+    start_states=None,
+    final_states=None,
+    workers: int = 1,
+    backend: Union[str, MatrixBackend] = None,
+) -> List[Set[Tuple[State, State]]]:
+    """Executes several regular queries to `bd_graph` at once.
+    The query DFAs are joined into one block-diagonal automaton, so the graph
+    is decomposed once and a single transitive closure of the intersection
+    serves all the queries.
+
+    Parameters
+    ----------
+    bd_graph: `networkx.MultiDiGraph` or `~project.graph_utils.LabeledGraph`
+        A source database
+    queries: iterable of `pyformlang.regular_expression.Regex`
+        Query regular expressions
+    start_states: iterable
+        Nodes in the graph that will be marked as the initial states of the automaton. By default, all vertices are marked.
+    final_states: iterable
+        Nodes in the graph that will be marked as the final states of the automaton. By default, all vertices are marked.
+    workers: int
+        Number of processes multiplying the row blocks of the matrices
+    backend: str or `~project.backends.MatrixBackend` or None
+        Storage of the closure: "sparse" (default), "bitset" or "auto"
+        to switch to bitsets when the closure becomes dense
+
+    Returns
+    -------
+    result: List[Set[`pyformlang.finite_automaton.State`, `pyformlang.finite_automaton.State`]]
+        For every query, the same pairs as `all_pair_rpq_from_graph` returns
+    """
+    queries = list(queries)
+    if not queries:
+        return []
+    graph = as_labeled_graph(bd_graph)
+    fa_bd = graph.to_matrix_automaton(start_states, final_states)
+    stacked, automata, offsets = _stack_queries(queries)
+    k = len(stacked)
+
+    intersect = fa.matrix_intersection(fa_bd, stacked, reachability_only=True)
+    trans_closure = fa.transitive_closure(
+        intersect.adjacency(), workers=workers, backend=backend
+    ).tocsr()
+
+    results = []
+    for offset, automaton in zip(offsets, automata):
+        rows = (fa_bd.start_idx[:, None] * k + offset + automaton.start_idx).ravel()
+        cols = (fa_bd.final_idx[:, None] * k + offset + automaton.final_idx).ravel()
+        result = set()
+        if len(rows) > 0 and len(cols) > 0:
+            frm, to = trans_closure[rows][:, cols].nonzero()
+            for i, j in zip((rows[frm] // k).tolist(), (cols[to] // k).tolist()):
+                result.add((fa_bd.states[i], fa_bd.states[j]))
+        results.append(result)
+    return results
+
+
+def bfs_rpq(
+    bd_graph: Union[MultiDiGraph, LabeledGraph],
+    query: fa.Regex,
+    start_states=None,
+    final_states=None,
+    separated: bool = False,
+):
+    """Executes a regular query to `bd_graph` with the multiple-source BFS.
+    A sparse front matrix with the reached (query state, vertex) pairs is advanced
+    over the boolean decompositions of the graph and the query DFA, so only the
+    region reachable from the start vertices is visited.
+
+    Parameters
+    ----------
+    bd_graph: `networkx.MultiDiGraph` or `~project.graph_utils.LabeledGraph`
+        A source database
+    query: `pyformlang.regular_expression.Regex`
+        Query regular expression
+    start_states: iterable
+        Nodes in the graph that will be marked as the initial states of the automaton. By default, all vertices are marked.
+    final_states: iterable
+        Nodes in the graph that will be marked as the final states of the automaton. By default, all vertices are marked.
+    separated: bool
+        If False, the vertices reachable from the whole set of start vertices are returned,
+        otherwise the reachable vertices are found for each start vertex.
+
+    Returns
+    -------
+    result: Set[`pyformlang.finite_automaton.State`] or Set[`pyformlang.finite_automaton.State`, `pyformlang.finite_automaton.State`]
+        Final States reachable by a path from `query`, or unique pairs of start and
+        final States connected by such a path if `separated` is True.
+    """
+    graph = as_labeled_graph(bd_graph)
+    graph_arrays = graph.arrays
+    dfa, (dfa_arrays, dfa_idx, dfa_states), _ = fa.compile_query(query)
+    if dfa.start_state is None or not dfa.final_states:
+        return set()
+
+    n, k = graph.number_of_nodes(), len(dfa_states)
+    if start_states is None:
+        starts = list(range(n))
+    else:
+        starts = graph.ids_of(start_states).tolist()
+    finals = set(range(n) if final_states is None else graph.ids_of(final_states))
+    dfa_start = dfa_idx[dfa.start_state]
+    dfa_finals = [dfa_idx[st] for st in dfa.final_states]
+
+    # row `b * k + q` of the front keeps the vertices reached in the query state `q`
+    # from the `b`-th start vertex, all start vertices share one block if not `separated`
+    blocks = len(starts) if separated else 1
+    rows = [(b if separated else 0) * k + dfa_start for b in range(len(starts))]
+    front = fa.array_type(
+        (np.ones(len(starts), dtype=bool), (rows, starts)),
+        shape=(blocks * k, n),
+        dtype=bool,
+    )
+    transitions = {
+        symb: sparse.kron(
+            sparse.identity(blocks, dtype=bool), dfa_arrays[symb].T, format="csc"
+        )
+        for symb in graph_arrays.keys() & dfa_arrays.keys()
+    }
+    visited = fa.array_type((blocks * k, n), dtype=bool)
+    while front.nnz > 0:
+        front = reduce(
+            lambda a, b: a + b,
+            (
+                masked_matmul(trans @ front, graph_arrays[symb], visited)
+                for symb, trans in transitions.items()
+            ),
+            fa.array_type((blocks * k, n), dtype=bool),
+        )
+        visited = visited + front
 
     result = set()
-    from_idx, to_idx = trans_closure.nonzero()
-    for i in range(len(from_idx)):
-        from_state = states[from_idx[i]].value[0]
-        to_state = states[to_idx[i]].value[0]
-        if from_state in bd.start_states:
-            if to_state in bd.final_states:
-                result.add((from_state, to_state))
+    for b in range(blocks):
+        for q in dfa_finals:
+            _, reached = visited[[b * k + q], :].nonzero()
+            for v in reached:
+                if v not in finals:
+                    continue
+                if separated:
+                    result.add((State(graph.nodes[starts[b]]), State(graph.nodes[v])))
+                else:
+                    result.add(State(graph.nodes[v]))
     return result
+
+
+RPQDelta = namedtuple("RPQDelta", ["added", "removed"])
+
+
+class RPQView:
+    """
+    The result of a fixed regular query maintained over a changing graph.
+    For every start vertex the set of reached pairs (vertex, query DFA state)
+    is kept, so an inserted edge is explored only from the sources that reach it,
+    and an edge deletion reverifies only the sources whose reached pairs used it.
+    A (start, final) pair is counted once per final DFA state it is reached in.
+    """
+
+    def __init__(self, query: fa.Regex, start_states=None, final_states=None):
+        """
+        Initializes an empty view of the query.
+
+        Parameters
+        ----------
+        query: `pyformlang.regular_expression.Regex`
+            Query regular expression
+        start_states: iterable
+            Nodes in the graph that will be marked as the initial states of the automaton. By default, all vertices are marked.
+        final_states: iterable
+            Nodes in the graph that will be marked as the final states of the automaton. By default, all vertices are marked.
+        """
+        dfa = fa.compile_query(query).dfa
+        self._start = dfa.start_state
+        self._table = dfa.to_dict()
+        self._dfa_finals = set(dfa.final_states)
+        self._by_label = defaultdict(list)
+        for q, transitions in self._table.items():
+            for symb, to in transitions.items():
+                self._by_label[symb].append((q, to))
+        self._starts = None if start_states is None else set(start_states)
+        self._finals = None if final_states is None else set(final_states)
+        # _out[v][label][u] is the number of edges (v, label, u)
+        self._out = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+        self._nodes = set()
+        self._reach = dict()
+        self._holders = defaultdict(set)
+        self._counts = defaultdict(int)
+        self._touched = dict()
+
+    @staticmethod
+    def from_graph(
+        bd_graph: Union[MultiDiGraph, LabeledGraph],
+        query: fa.Regex,
+        start_states=None,
+        final_states=None,
+    ) -> "RPQView":
+        """
+        Builds the view of the query over `bd_graph`.
+
+        Parameters
+        ----------
+        bd_graph: `networkx.MultiDiGraph` or `~project.graph_utils.LabeledGraph`
+            A source database
+        query: `pyformlang.regular_expression.Regex`
+            Query regular expression
+        start_states: iterable
+            Nodes in the graph that will be marked as the initial states of the automaton. By default, all vertices are marked.
+        final_states: iterable
+            Nodes in the graph that will be marked as the final states of the automaton. By default, all vertices are marked.
+
+        Returns
+        -------
+        RPQView
+            The view with the pairs of `all_pair_rpq_from_graph`
+        """
+        view = RPQView(query, start_states, final_states)
+        if isinstance(bd_graph, LabeledGraph):
+            nodes = bd_graph.nodes
+            if isinstance(nodes, np.ndarray):
+                nodes = nodes.tolist()
+            edges = [
+                (nodes[v], label, nodes[u])
+                for label, array in bd_graph.arrays.items()
+                for v, u in zip(*(ids.tolist() for ids in array.nonzero()))
+            ]
+        else:
+            nodes = bd_graph.nodes
+            edges = [(v, label, u) for v, u, label in bd_graph.edges(data="label")]
+        view.update(added=edges, nodes=nodes)
+        return view
+
+    def pairs(self) -> Set[Tuple[State, State]]:
+        """
+        Returns unique pairs of start and final States that are connected by a path from the query.
+        """
+        return {(State(s), State(u)) for s, u in self._counts}
+
+    def update(self, added=(), removed=(), nodes=()) -> RPQDelta:
+        """
+        Applies a batch of edge deletions and insertions.
+
+        Parameters
+        ----------
+        added: iterable of (node, label, node)
+            The inserted edges, the nodes missing in the graph are added
+        removed: iterable of (node, label, node)
+            The deleted edges, an edge inserted several times is removed once per deletion
+        nodes: iterable
+            The inserted vertices without edges
+
+        Returns
+        -------
+        delta: `RPQDelta`
+            The named tuple with the sets of pairs of start and final States
+            that were `added` to the result and `removed` from it by the batch
+        """
+        self._touched = dict()
+        affected = set()
+        for v, label, u in removed:
+            counts = self._out[v][label]
+            if counts.get(u, 0) == 0:
+                continue
+            counts[u] -= 1
+            if counts[u] > 0:
+                continue
+            del counts[u]
+            for q, to in self._by_label.get(label, ()):
+                affected.update(
+                    s
+                    for s in self._holders.get((v, q), ())
+                    if (u, to) in self._reach[s]
+                )
+        for s in affected:
+            self._reverify(s)
+
+        added = list(added)
+        for node in nodes:
+            self._add_node(node)
+        for v, _, u in added:
+            self._add_node(v)
+            self._add_node(u)
+        for v, label, u in added:
+            counts = self._out[v][label]
+            counts[u] += 1
+            if counts[u] > 1:
+                continue
+            for q, to in self._by_label.get(label, ()):
+                for s in tuple(self._holders.get((v, q), ())):
+                    self._visit(s, [(u, to)])
+
+        delta = RPQDelta(set(), set())
+        for (s, u), was in self._touched.items():
+            now = (s, u) in self._counts
+            if now and not was:
+                delta.added.add((State(s), State(u)))
+            elif was and not now:
+                delta.removed.add((State(s), State(u)))
+        return delta
+
+    def add_edges(self, edges) -> RPQDelta:
+        """Inserts the edges (node, label, node), see `RPQView.update`"""
+        return self.update(added=edges)
+
+    def remove_edges(self, edges) -> RPQDelta:
+        """Deletes the edges (node, label, node), see `RPQView.update`"""
+        return self.update(removed=edges)
+
+    def _add_node(self, node):
+        if node in self._nodes:
+            return
+        self._nodes.add(node)
+        if self._start is None or (
+            self._starts is not None and node not in self._starts
+        ):
+            return
+        self._reach[node] = set()
+        self._holders[(node, self._start)].add(node)
+        self._visit(node, [])
+
+    def _count(self, s, u, q, diff):
+        if q not in self._dfa_finals or (
+            self._finals is not None and u not in self._finals
+        ):
+            return
+        pair = (s, u)
+        if pair not in self._touched:
+            self._touched[pair] = pair in self._counts
+        self._counts[pair] += diff
+        if self._counts[pair] == 0:
+            del self._counts[pair]
+
+    def _visit(self, s, states):
+        """Extends the reached pairs of the source `s` with `states` and everything reachable from them"""
+        reach = self._reach[s]
+        stack = []
+        for state in states:
+            if state not in reach:
+                reach.add(state)
+                self._holders[state].add(s)
+                self._count(s, state[0], state[1], 1)
+                stack.append(state)
+        if not states:
+            stack.append((s, self._start))
+        while stack:
+            v, q = stack.pop()
+            transitions = self._table.get(q, {})
+            for label, counts in self._out[v].items():
+                to = transitions.get(label)
+                if to is None:
+                    continue
+                for u in counts:
+                    if (u, to) in reach:
+                        continue
+                    reach.add((u, to))
+                    self._holders[(u, to)].add(s)
+                    self._count(s, u, to, 1)
+                    stack.append((u, to))
+
+    def _reverify(self, s):
+        """Recomputes the reached pairs of the source `s` from its start pair"""
+        for v, q in self._reach[s]:
+            self._holders[(v, q)].discard(s)
+            self._count(s, v, q, -1)
+        self._holders[(s, self._start)].add(s)
+        self._reach[s] = set()
+        self._visit(s, [])
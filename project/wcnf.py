@@ -1,7 +1,11 @@
 """
 A module for converting context-free grammar to weakened Chomsky normal form
 """
-from pyformlang.cfg import CFG
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Tuple, Union
+from pyformlang.cfg import CFG, Production, Terminal, Variable
+import hashlib
+import json
 
 
 def to_wcnf(_cfg: CFG) -> CFG:
@@ -43,3 +47,213 @@ def wcnf_from_file(path: str) -> CFG:
     with open(path) as src:
         _cfg = CFG.from_text(src.read())
         return to_wcnf(_cfg)
+
+
+def grammar_fingerprint(_cfg: CFG) -> str:
+    """
+    Returns the sha256 digest of the start symbol and the productions of `_cfg`,
+    grammars with the same productions have the same fingerprint.
+    """
+    digest = hashlib.sha256()
+    digest.update(str(_cfg.start_symbol).encode())
+    for production in sorted(str(p) for p in _cfg.productions):
+        digest.update(b"\n" + production.encode())
+    return digest.hexdigest()
+
+
+class CompiledGrammar:
+    """
+    Context-free grammar in weakened Chomsky normal form with integer-coded
+    nonterminals and terminals and the production tables used by the CFPQ engines
+    """
+
+    def __init__(
+        self,
+        variables: List[Variable],
+        terminals: List,
+        start: int,
+        eps_heads: List[int],
+        heads_by_term: Dict[int, List[int]],
+        heads_by_body: Dict[Tuple[int, int], List[int]],
+        fingerprint: str = None,
+    ):
+        """
+        Initializes an instance of the CompiledGrammar class.
+
+        Parameters
+        ----------
+        variables : list of Variable
+            The nonterminal of every id
+        terminals : list
+            The terminal value of every id
+        start : int
+            Id of the start nonterminal, -1 if the grammar has no start nonterminal
+        eps_heads : list of int
+            Ids of the nonterminals `N` with productions `N -> eps`
+        heads_by_term : dict of int and list of int
+            Ids of the nonterminals `N` with productions `N -> t` by the id of `t`
+        heads_by_body : dict of (int, int) and list of int
+            Ids of the nonterminals `N` with productions `N -> A B` by the ids of `A`, `B`
+        fingerprint : str, optional
+            Fingerprint of the source grammar
+        """
+        self.variables = variables
+        self.terminals = terminals
+        self.start = start
+        self.eps_heads = eps_heads
+        self.heads_by_term = heads_by_term
+        self.heads_by_body = heads_by_body
+        self.fingerprint = fingerprint
+        self.var_ids = {var: i for i, var in enumerate(variables)}
+        self.term_ids = {term: i for i, term in enumerate(terminals)}
+        self.rights_by_left = defaultdict(set)
+        self.lefts_by_right = defaultdict(set)
+        for left, right in heads_by_body:
+            self.rights_by_left[left].add(right)
+            self.lefts_by_right[right].add(left)
+
+    @staticmethod
+    def from_cfg(_cfg: CFG) -> "CompiledGrammar":
+        """
+        Converts `_cfg` into WCNF and builds its production tables.
+
+        Parameters
+        ----------
+        _cfg: ~`pyformlang.cfg.CFG`
+            Any context free grammar
+
+        Returns
+        -------
+        CompiledGrammar
+            The compiled WCNF of `_cfg`
+        """
+        w_cfg = to_wcnf(_cfg)
+        variables = sorted(w_cfg.variables, key=lambda var: str(var.value))
+        terminals = sorted({t.value for t in w_cfg.terminals}, key=str)
+        var_ids = {var: i for i, var in enumerate(variables)}
+        term_ids = {term: i for i, term in enumerate(terminals)}
+        eps_heads = set()
+        heads_by_term = defaultdict(set)
+        heads_by_body = defaultdict(set)
+        for p in w_cfg.productions:
+            head = var_ids[p.head]
+            if not p.body:
+                eps_heads.add(head)
+            elif len(p.body) == 1:
+                heads_by_term[term_ids[p.body[0].value]].add(head)
+            else:
+                heads_by_body[(var_ids[p.body[0]], var_ids[p.body[1]])].add(head)
+        return CompiledGrammar(
+            variables,
+            terminals,
+            var_ids.get(w_cfg.start_symbol, -1),
+            sorted(eps_heads),
+            {t: sorted(heads) for t, heads in heads_by_term.items()},
+            {body: sorted(heads) for body, heads in heads_by_body.items()},
+            grammar_fingerprint(_cfg),
+        )
+
+    def to_cfg(self) -> CFG:
+        """
+        Returns the WCNF grammar as a pyformlang CFG.
+        """
+        productions = {Production(self.variables[h], []) for h in self.eps_heads}
+        for t, heads in self.heads_by_term.items():
+            for h in heads:
+                productions.add(
+                    Production(self.variables[h], [Terminal(self.terminals[t])])
+                )
+        for (left, right), heads in self.heads_by_body.items():
+            body = [self.variables[left], self.variables[right]]
+            for h in heads:
+                productions.add(Production(self.variables[h], body))
+        start = self.variables[self.start] if self.start >= 0 else None
+        return CFG(start_symbol=start, productions=productions)
+
+    def save(self, path: str):
+        """
+        Writes the compiled grammar to the JSON file `path`.
+        """
+        with open(path, "w") as dst:
+            json.dump(
+                {
+                    "fingerprint": self.fingerprint,
+                    "variables": [var.value for var in self.variables],
+                    "terminals": self.terminals,
+                    "start": self.start,
+                    "eps_heads": self.eps_heads,
+                    "heads_by_term": [[t, h] for t, h in self.heads_by_term.items()],
+                    "heads_by_body": [
+                        [l, r, h] for (l, r), h in self.heads_by_body.items()
+                    ],
+                },
+                dst,
+            )
+
+    @staticmethod
+    def load(path: str) -> "CompiledGrammar":
+        """
+        Reads the compiled grammar written by `CompiledGrammar.save`.
+        """
+        with open(path) as src:
+            data = json.load(src)
+        return CompiledGrammar(
+            [Variable(value) for value in data["variables"]],
+            data["terminals"],
+            data["start"],
+            data["eps_heads"],
+            {t: heads for t, heads in data["heads_by_term"]},
+            {(l, r): heads for l, r, heads in data["heads_by_body"]},
+            data["fingerprint"],
+        )
+
+
+_COMPILED_GRAMMARS = OrderedDict()
+COMPILED_CACHE_SIZE = 64
+
+
+def compile_grammar(_cfg: Union[CFG, CompiledGrammar]) -> CompiledGrammar:
+    """
+    Returns the compiled WCNF of `_cfg`, the grammars are cached by fingerprint,
+    so a grammar is converted only once. A compiled grammar is returned as is.
+
+    Parameters
+    ----------
+    _cfg: ~`pyformlang.cfg.CFG` or `CompiledGrammar`
+        Any context free grammar
+
+    Returns
+    -------
+    grammar: `CompiledGrammar`
+        The compiled grammar, it must not be modified
+    """
+    if isinstance(_cfg, CompiledGrammar):
+        return _cfg
+    fingerprint = grammar_fingerprint(_cfg)
+    grammar = _COMPILED_GRAMMARS.get(fingerprint)
+    if grammar is None:
+        grammar = CompiledGrammar.from_cfg(_cfg)
+        _COMPILED_GRAMMARS[fingerprint] = grammar
+        if len(_COMPILED_GRAMMARS) > COMPILED_CACHE_SIZE:
+            _COMPILED_GRAMMARS.popitem(last=False)
+    else:
+        _COMPILED_GRAMMARS.move_to_end(fingerprint)
+    return grammar
+
+
+def compiled_grammar_from_file(path: str) -> CompiledGrammar:
+    """
+    Read context free grammar from file `path` and compile its WCNF
+
+    Parameters
+    ----------
+    path: str
+        Path to file with cfg
+
+    Returns
+    -------
+    grammar: `CompiledGrammar`
+        The compiled grammar in weakened Chomsky normal form (WNFX)
+    """
+    with open(path) as src:
+        return compile_grammar(CFG.from_text(src.read()))
@@ -0,0 +1,60 @@
+import pytest
+from scipy import sparse
+from pyformlang.cfg import CFG
+from pyformlang.regular_expression import Regex
+from project import backends
+from project.backends import BitMatrix
+from project import graph_utils as gu
+import project.cfqp as cfqp
+import project.fa_utils as fa
+import project.tensor as rpq
+
+
+def random_bool(rows, cols, density, seed):
+    return sparse.csc_array(sparse.random(rows, cols, density, random_state=seed) > 0)
+
+
+@pytest.mark.parametrize("n, m, k", [(5, 70, 130), (200, 65, 64), (0, 3, 3)])
+def test_bit_matrix_operations(n, m, k):
+    a, b, c = (
+        random_bool(n, m, 0.1, 1),
+        random_bool(m, k, 0.1, 2),
+        random_bool(n, m, 0.1, 3),
+    )
+    bits_a, bits_b, bits_c = map(BitMatrix.from_sparse, (a, b, c))
+    assert bits_a.nnz == a.nnz
+    assert ((bits_a @ bits_b).tocsc() != a @ b).nnz == 0
+    assert ((a @ bits_b).tocsc() != a @ b).nnz == 0
+    assert ((bits_a + c).tocsc() != a + c).nnz == 0
+    assert ((bits_a > bits_c).tocsc() != (a > c)).nnz == 0
+    assert ((a > bits_c).tocsc() != (a > c)).nnz == 0
+    assert (bits_a.toarray() == a.toarray()).all()
+
+
+def test_backend_selection():
+    dense = random_bool(10, 10, 0.5, 1)
+    assert backends.get_backend().name == "sparse"
+    assert backends.get_backend("auto", dense).name == "bitset"
+    assert (
+        backends.get_backend("auto", random_bool(100, 100, 0.001, 1)).name == "sparse"
+    )
+    assert isinstance(backends.to_backend(dense, "auto"), BitMatrix)
+    with pytest.raises(ValueError):
+        backends.get_backend("dense")
+
+
+@pytest.mark.parametrize("backend", ["bitset", "auto"])
+def test_engines_with_backends(backend):
+    graph = gu.generate_two_cycles_graph(3, 4, ("a", "b"))
+    cfg = CFG.from_text("S -> a S b | a b")
+    expected = cfqp.matrix_rpq(graph, cfg)
+    assert cfqp.matrix_rpq(graph, cfg, backend=backend) == expected
+
+    query = Regex("a* b")
+    expected = rpq.all_pair_rpq_from_graph(graph, query)
+    assert rpq.all_pair_rpq_from_graph(graph, query, backend=backend) == expected
+
+    decomposition = fa.boolean_decomposition(
+        fa.build_minimal_dfa_from_regex(query), backend="bitset"
+    )
+    assert all(isinstance(m, BitMatrix) for m in decomposition.arrays.values())
@@ -137,3 +137,29 @@ def test_from_file():
         f.write(cfg_text)
     cfg = cu.wcnf_from_file(fname)
     assert_equal(cfg.to_text(), whnf_cfg_text)
+
+
+def test_compiled_grammar(tmp_path):
+    cfg = CFG.from_text(
+        """
+    S -> A B | $
+    A -> a
+    B -> S b"""
+    )
+    grammar = cu.compile_grammar(cfg)
+    assert cu.compile_grammar(CFG.from_text(cfg.to_text())) is grammar
+    assert cu.compile_grammar(grammar) is grammar
+    assert grammar.variables[grammar.start].value == "S"
+    assert [grammar.variables[h].value for h in grammar.eps_heads] == ["S"]
+    a, b = grammar.term_ids["a"], grammar.term_ids["b"]
+    assert [grammar.variables[h].value for h in grammar.heads_by_term[a]] == ["A"]
+    assert len(grammar.heads_by_term[b]) == 1
+    assert set(grammar.to_cfg().productions) == set(cu.to_wcnf(cfg).productions)
+
+    path = tmp_path / "grammar.json"
+    grammar.save(path)
+    loaded = cu.CompiledGrammar.load(path)
+    assert loaded.fingerprint == grammar.fingerprint
+    assert loaded.heads_by_body == grammar.heads_by_body
+    assert loaded.heads_by_term == grammar.heads_by_term
+    assert set(loaded.to_cfg().productions) == set(grammar.to_cfg().productions)
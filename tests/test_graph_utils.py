@@ -1,5 +1,7 @@
+import gzip
 import pytest
 import networkx as nx
+import numpy as np
 from project import graph_utils as gu
 
 
@@ -34,3 +36,103 @@ def test_graph_info():
     assert info.number_of_edges == avrora_graph.number_of_edges()
     assert info.number_of_nodes == avrora_graph.number_of_nodes()
     assert info.labels == gu.unique_labels(avrora_graph)
+
+
+def test_labeled_graph_from_networkx():
+    graph = nx.MultiDiGraph(
+        [
+            ("x", "y", {"label": "a"}),
+            ("y", "z", {"label": "b"}),
+            ("z", "x", {"label": "a"}),
+        ]
+    )
+    graph.add_node("w")
+    labeled = gu.LabeledGraph.from_networkx(graph)
+    assert labeled.number_of_nodes() == graph.number_of_nodes()
+    assert labeled.number_of_edges() == graph.number_of_edges()
+    assert labeled.labels() == gu.unique_labels(graph)
+    assert labeled.label_stats() == {"a": 2, "b": 1}
+    assert labeled.arrays["a"].indices.dtype == np.int32
+    x, y = labeled.idx["x"], labeled.idx["y"]
+    assert labeled.arrays["a"][x, y]
+
+    restored = labeled.to_networkx()
+    assert set(restored.edges(data="label")) == set(graph.edges(data="label"))
+
+
+def test_labeled_graph_reachable_subgraph():
+    graph = gu.LabeledGraph.from_networkx(
+        nx.MultiDiGraph([(0, 1, {"label": "a"}), (1, 2, {"label": "b"})])
+    )
+    forward = graph.reachable(graph.ids_of([1]))
+    backward = graph.reachable(graph.ids_of([1]), reverse=True)
+    assert {graph.nodes[i] for i in np.flatnonzero(forward)} == {1, 2}
+    assert {graph.nodes[i] for i in np.flatnonzero(backward)} == {0, 1}
+
+    sub = graph.subgraph(np.flatnonzero(forward))
+    assert sub.nodes == [1, 2]
+    assert sub.label_stats() == {"a": 0, "b": 1}
+
+
+def test_cached_graph_loading(tmp_path):
+    path = str(tmp_path / "two_cycles.dot")
+    cache_dir = tmp_path / "cache"
+    gu.generate_two_cycles_graph(3, 4, ("one", "two"), path)
+
+    graph = gu.load_cached_graph_from_file(path, cache_dir)
+    assert [p.name for p in cache_dir.iterdir()] == [gu.file_hash(path)]
+    from_file = gu.LabeledGraph.from_networkx(gu.load_graph_from_file(path))
+    assert list(graph.nodes) == from_file.nodes
+    assert graph.label_stats() == from_file.label_stats()
+
+    cached = gu.load_cached_graph_from_file(path, cache_dir)
+    assert isinstance(cached.nodes, np.memmap)
+    for label, matrix in from_file.arrays.items():
+        assert (cached.arrays[label] != matrix).nnz == 0
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_stream_graph_from_edge_list(tmp_path, compress):
+    text = "0 a 1\n1 b 2\n2 a 0\n\n1 b 2\n"
+    path = tmp_path / ("edges.txt.gz" if compress else "edges.txt")
+    if compress:
+        with gzip.open(path, "wt") as dst:
+            dst.write(text)
+    else:
+        path.write_text(text)
+
+    graph, stats = gu.stream_graph_from_edge_list(
+        str(path), node_type=int, chunk_size=2
+    )
+    assert stats.number_of_edges == 4
+    assert graph.nodes == [0, 1, 2]
+    assert graph.label_stats() == {"a": 2, "b": 1}
+    assert graph.arrays["b"][graph.idx[1], graph.idx[2]]
+
+
+def test_stream_graph_from_csv(tmp_path):
+    path = tmp_path / "edges.csv"
+    path.write_text("x,y,knows\ny,z,likes\n")
+    graph, _ = gu.stream_graph_from_edge_list(
+        str(path), order=("src", "dst", "label"), sep=","
+    )
+    assert graph.labels() == {"knows", "likes"}
+    assert graph.arrays["likes"][graph.idx["y"], graph.idx["z"]]
+
+
+def test_offline_registry(tmp_path, monkeypatch):
+    def no_network(name):
+        raise AssertionError("registry lookup must not download")
+
+    graph = gu.generate_two_cycles_graph(3, 4, ("a", "b"))
+    info = gu.register_graph("two_cycles", graph, tmp_path)
+    monkeypatch.setattr(gu.cd, "download", no_network)
+
+    assert gu.graph_info_by_name("two_cycles", tmp_path) == info
+    assert info == gu.GraphInfo(9, 8, {"a", "b"})
+    loaded = gu.load_graph_by_name("two_cycles", tmp_path)
+    assert set(loaded.edges(data="label")) == set(graph.edges(data="label"))
+    labeled = gu.load_labeled_graph_by_name("two_cycles", tmp_path)
+    assert labeled.number_of_edges() == 9
+    with pytest.raises(KeyError):
+        gu.load_labeled_graph_by_name("missing", tmp_path)
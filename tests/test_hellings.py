@@ -85,3 +85,37 @@ def test_helling_with_starts():
     expected = {(1, Variable("N"), 3), (1, Variable("B"), 2)}
     res = cfqp.rpq(cfqp.RPQMethods.Hellings, gr, cfg, None, [1])
     assert expected == res
+
+
+def test_hellings_same_as_matrix_on_cycle():
+    gr = MultiDiGraph(
+        [
+            (0, 1, {"label": "a"}),
+            (1, 2, {"label": "a"}),
+            (2, 0, {"label": "a"}),
+            (0, 3, {"label": "b"}),
+            (3, 0, {"label": "b"}),
+        ]
+    )
+    cfg = CFG.from_text("S -> a S b | a b")
+
+    hellings = cfqp.all_pairs_rpq(cfqp.RPQMethods.Hellings, gr, cfg)
+    matrix = cfqp.all_pairs_rpq(cfqp.RPQMethods.Matrix, gr, cfg)
+    assert hellings == matrix
+    assert (2, Variable("S"), 0) in hellings
+
+
+def test_hellings_with_starts_and_finals():
+    gr = MultiDiGraph(
+        [
+            (0, 1, {"label": "a"}),
+            (1, 2, {"label": "a"}),
+            (2, 3, {"label": "b"}),
+            (3, 4, {"label": "b"}),
+            (5, 0, {"label": "a"}),
+        ]
+    )
+    cfg = CFG.from_text("S -> a S b | a b")
+
+    res = cfqp.rpq(cfqp.RPQMethods.Hellings, gr, cfg, "S", [0, 1], [4])
+    assert res == {(0, Variable("S"), 4)}
@@ -3,6 +3,7 @@ import project
 from pyformlang.cfg import Variable, CFG
 from project import graph_utils as gu
 import project.cfqp as cfqp
+from project.wcnf import compile_grammar
 from networkx import MultiDiGraph
 
 simple_cfg_text = """
@@ -85,3 +86,102 @@ def test_with_starts():
     expected = {(1, Variable("N"), 3), (1, Variable("B"), 2)}
     res = cfqp.rpq(cfqp.RPQMethods.Matrix, gr, cfg, None, [1])
     assert expected == res
+
+
+def test_matrix_same_as_hellings_on_two_cycles():
+    gr = gu.generate_two_cycles_graph(3, 4, ("a", "b"))
+    cfg = CFG.from_text("S -> a S b S | $")
+
+    matrix = cfqp.all_pairs_rpq(cfqp.RPQMethods.Matrix, gr, cfg)
+    hellings = cfqp.all_pairs_rpq(cfqp.RPQMethods.Hellings, gr, cfg)
+    assert matrix == hellings
+    for v in gr.nodes():
+        assert (v, Variable("S"), v) in matrix
+
+
+def test_matrix_closure_skips_unchanged_bodies():
+    gr = MultiDiGraph(
+        [
+            (0, 1, {"label": "a"}),
+            (1, 2, {"label": "a"}),
+            (2, 3, {"label": "a"}),
+            (3, 4, {"label": "b"}),
+        ]
+    )
+    cfg = CFG.from_text(
+        """
+    S -> A B
+    A -> a A | a
+    B -> b"""
+    )
+
+    matrices, nodes, stats = cfqp.matrix_closure(gr, cfg)
+    assert stats.skipped > 0
+    s_matrix = matrices[Variable("S")]
+    s_pairs = {(nodes[i], nodes[j]) for i, j in zip(*s_matrix.nonzero())}
+    assert s_pairs == {(0, 4), (1, 4), (2, 4)}
+
+
+def test_matrices_with_starts_and_finals():
+    gr = MultiDiGraph(
+        [
+            (0, 1, {"label": "a"}),
+            (1, 2, {"label": "a"}),
+            (2, 3, {"label": "b"}),
+            (3, 4, {"label": "b"}),
+            (5, 0, {"label": "a"}),
+        ]
+    )
+    cfg = CFG.from_text("S -> a S b | a b")
+
+    res = cfqp.rpq(cfqp.RPQMethods.Matrix, gr, cfg, "S", [0, 1], [4])
+    assert res == {(0, Variable("S"), 4)}
+
+
+def test_matrix_on_labeled_graph():
+    gr = gu.generate_two_cycles_graph(3, 4, ("a", "b"))
+    cfg = CFG.from_text("S -> a S b | a b")
+
+    expected = cfqp.all_pairs_rpq(cfqp.RPQMethods.Matrix, gr, cfg)
+    labeled = gu.LabeledGraph.from_networkx(gr)
+    for method in cfqp.RPQMethods:
+        res = cfqp.all_pairs_rpq(method, labeled, cfg)
+        assert {x for x in res if x[1] == Variable("S")} == {
+            x for x in expected if x[1] == Variable("S")
+        }
+
+
+def test_engines_accept_compiled_grammar():
+    gr = MultiDiGraph(
+        [
+            (0, 1, {"label": "a"}),
+            (1, 2, {"label": "a"}),
+            (2, 3, {"label": "b"}),
+            (3, 0, {"label": "b"}),
+        ]
+    )
+    cfg = CFG.from_text("S -> a S b | a b")
+    grammar = compile_grammar(cfg)
+    for method in cfqp.RPQMethods:
+        # the tensor engine keeps the nonterminals of the given grammar
+        source = grammar.to_cfg() if method == cfqp.RPQMethods.Tensor else cfg
+        expected = cfqp.all_pairs_rpq(method, gr, source)
+        assert cfqp.all_pairs_rpq(method, gr, grammar) == expected
+    assert cfqp.rpq(cfqp.RPQMethods.Matrix, gr, grammar, "S", start_v={0}) == cfqp.rpq(
+        cfqp.RPQMethods.Matrix, gr, cfg, "S", start_v={0}
+    )
+
+
+def test_cfpq_index_add_edges():
+    gr = MultiDiGraph([(0, 1, {"label": "a"}), (1, 2, {"label": "a"})])
+    cfg = CFG.from_text("S -> a S b | a b")
+    index = cfqp.CFPQIndex.from_graph(gr, cfg)
+    assert index.triples() == cfqp.matrix_rpq(gr, cfg)
+
+    delta = index.add_edges([(2, "b", 3), (3, "b", 4)])
+    assert {(v, u) for v, N, u in delta if N == Variable("S")} == {(1, 3), (0, 4)}
+    assert index.add_edges([(2, "b", 3)]) == set()
+
+    gr.add_edge(2, 3, label="b")
+    gr.add_edge(3, 4, label="b")
+    assert index.triples() == cfqp.matrix_rpq(gr, cfg)
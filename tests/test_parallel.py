@@ -0,0 +1,34 @@
+import pytest
+import numpy as np
+from scipy import sparse
+from pyformlang.cfg import CFG
+from pyformlang.regular_expression import Regex
+from project import graph_utils as gu
+from project import parallel
+import project.cfqp as cfqp
+import project.tensor as rpq
+
+
+@pytest.fixture
+def always_parallel(monkeypatch):
+    monkeypatch.setattr(parallel, "PARALLEL_MIN_NNZ", 0)
+
+
+@pytest.mark.parametrize("density", [0.0, 0.01, 0.3])
+def test_parallel_matmul(always_parallel, density):
+    left = sparse.csc_array(sparse.random(300, 200, density, random_state=1) > 0)
+    right = sparse.csr_array(sparse.random(200, 100, density, random_state=2) > 0)
+    product = parallel.parallel_matmul(left, right, 3)
+    assert product.format == "csc" and product.dtype == bool
+    assert (product != left @ right).nnz == 0
+
+
+def test_parallel_engines(always_parallel):
+    graph = gu.generate_two_cycles_graph(4, 5, ("a", "b"))
+    cfg = CFG.from_text("S -> a S b | a b")
+    assert cfqp.matrix_rpq(graph, cfg, workers=2) == cfqp.matrix_rpq(graph, cfg)
+    query = Regex("a* b")
+    assert rpq.all_pair_rpq_from_graph(
+        graph, query, workers=2
+    ) == rpq.all_pair_rpq_from_graph(graph, query)
+    assert rpq.batch_rpq(graph, [query], workers=2) == rpq.batch_rpq(graph, [query])
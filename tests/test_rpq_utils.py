@@ -117,3 +117,184 @@ def test_full_graph_rpq():
     for start in bd.nodes():
         for final in bd.nodes():
             assert (start, final) in result
+
+
+@pytest.mark.parametrize(
+    "q_regex, expected",
+    [
+        (my_fa.Regex("(a b)*"), {2}),
+        (my_fa.Regex("(a b)* | (a c)"), {2, 3}),
+        (my_fa.Regex("(a)*"), set()),
+    ],
+)
+def test_bfs_rpq(q_regex, expected):
+    bd = MultiDiGraph(
+        [(0, 1, {"label": "a"}), (1, 2, {"label": "b"}), (1, 3, {"label": "c"})]
+    )
+    result = rpq.bfs_rpq(bd, q_regex, start_states=[0], final_states=[2, 3])
+    assert result == expected
+
+
+def test_bfs_rpq_separated():
+    bd = MultiDiGraph(
+        [
+            (0, 1, {"label": "a"}),
+            (1, 2, {"label": "b"}),
+            (3, 1, {"label": "a"}),
+            (2, 4, {"label": "b"}),
+        ]
+    )
+    query = my_fa.Regex("a b*")
+    result = rpq.bfs_rpq(bd, query, start_states=[0, 3, 2], separated=True)
+    expected = {(s, f) for s in [0, 3] for f in [1, 2, 4]}
+    assert result == expected
+    assert rpq.bfs_rpq(bd, query, start_states=[0, 3, 2]) == {1, 2, 4}
+
+
+def test_transitive_closure():
+    edges = fa.array_type(([True] * 3, ([0, 1, 2], [1, 2, 3])), shape=(5, 5))
+    closure = fa.transitive_closure(edges)
+    assert set(zip(*closure.nonzero())) == {
+        (0, 1),
+        (0, 2),
+        (0, 3),
+        (1, 2),
+        (1, 3),
+        (2, 3),
+    }
+    new_edges = fa.array_type(([True], ([3], [4])), shape=(5, 5))
+    extended = fa.transitive_closure(new_edges, closure)
+    assert set(zip(*extended.nonzero())) == set(zip(*closure.nonzero())) | {
+        (0, 4),
+        (1, 4),
+        (2, 4),
+        (3, 4),
+    }
+
+
+def test_rpq_respects_query_states():
+    bd = MultiDiGraph([(0, 1, {"label": "b"}), (1, 2, {"label": "b"})])
+    result = rpq.all_pair_rpq_from_graph(bd, my_fa.Regex("a b*"))
+    assert len(result) == 0
+
+
+def test_boolean_decomposition():
+    enfa = EpsilonNFA()
+    enfa.add_start_state(State(0))
+    enfa.add_final_state(State(2))
+    enfa.add_transition(State(0), "a", State(1))
+    enfa.add_transition(State(1), "epsilon", State(2))
+    enfa.add_transition(State(2), "b", State(0))
+
+    arrays, idx, states = fa.boolean_decomposition(enfa)
+    assert set(arrays.keys()) == {"a", "b"}
+    assert all(isinstance(arr, fa.array_type) for arr in arrays.values())
+    assert set(zip(*arrays["a"].nonzero())) == {(idx[State(0)], idx[State(1)])}
+    assert set(zip(*arrays["b"].nonzero())) == {
+        (idx[State(1)], idx[State(0)]),
+        (idx[State(2)], idx[State(0)]),
+    }
+    dfa = fa.build_minimal_dfa_from_regex(my_fa.Regex("a b"))
+    assert fa.epsilon_free(dfa) is dfa
+
+
+def test_matrix_intersection():
+    fa1 = my_fa.build_minimal_dfa_from_regex(my_fa.Regex("(a b)*"))
+    fa2 = my_fa.build_minimal_dfa_from_regex(my_fa.Regex("a b a b"))
+    product = fa.matrix_intersection(fa1, fa2)
+    assert len(product) == len(fa1.states) * len(fa2.states)
+    assert set(product.arrays.keys()) == {"a", "b"}
+    assert len(product.start_idx) == 1
+    assert product.to_epsilon_nfa().accepts("abab")
+
+    reachability = fa.matrix_intersection(fa1, fa2, reachability_only=True)
+    assert reachability.arrays == {}
+    assert (reachability.adjacency() != product.adjacency()).nnz == 0
+
+
+@pytest.mark.parametrize(
+    "q_regex",
+    [
+        my_fa.Regex("(a b)*"),
+        my_fa.Regex("(a b)* | (a c)"),
+        my_fa.Regex("a (b | c) d*"),
+    ],
+)
+def test_on_the_fly_graph_rpq(q_regex):
+    bd = MultiDiGraph(
+        [
+            (0, 1, {"label": "a"}),
+            (1, 2, {"label": "b"}),
+            (1, 3, {"label": "c"}),
+            (3, 3, {"label": "d"}),
+            (2, 0, {"label": "a"}),
+        ]
+    )
+    expected = rpq.all_pair_rpq_from_graph(bd, q_regex)
+    result = rpq.all_pair_rpq_from_graph(bd, q_regex, on_the_fly=True)
+    assert result == expected
+
+
+def test_query_cache_counters_and_eviction():
+    cache = fa.QueryCache(max_entries=2)
+    first = fa.compile_query("a  (b | c)*", cache)
+    assert fa.compile_query(" a (b | c)* ", cache) is first
+    fa.compile_query(my_fa.Regex("d"), cache)
+    fa.compile_query("e", cache)
+    assert cache.stats()[:4] == (1, 3, 1, 2)
+    assert "a (b | c)*" not in cache and "e" in cache
+    assert first.dfa.is_equivalent_to(fa.build_minimal_dfa_from_regex_str("a (b|c)*"))
+
+    tiny = fa.QueryCache(max_bytes=0)
+    fa.compile_query("a b", tiny)
+    assert len(tiny) == 0 and tiny.stats().misses == 1
+
+
+def test_rpq_uses_query_cache():
+    bd = MultiDiGraph([(0, 1, {"label": "a"}), (1, 2, {"label": "b"})])
+    query = my_fa.Regex("a b*")
+    fa.QUERY_CACHE.clear()
+    expected = {(State(0), State(1)), (State(0), State(2))}
+    assert rpq.all_pair_rpq_from_graph(bd, query) == expected
+    assert rpq.all_pair_rpq_from_graph(bd, query) == expected
+    assert fa.QUERY_CACHE.stats()[:2] == (1, 1)
+
+
+def test_batch_rpq():
+    bd = MultiDiGraph(
+        [
+            (0, 1, {"label": "a"}),
+            (1, 2, {"label": "b"}),
+            (1, 3, {"label": "c"}),
+            (3, 3, {"label": "d"}),
+            (2, 0, {"label": "a"}),
+        ]
+    )
+    queries = [
+        my_fa.Regex("(a b)*"),
+        my_fa.Regex("a (b | c) d*"),
+        my_fa.Regex("x"),
+    ]
+    results = rpq.batch_rpq(bd, queries, start_states={0, 2})
+    assert len(results) == 3
+    for query, result in zip(queries, results):
+        assert result == rpq.all_pair_rpq_from_graph(bd, query, start_states={0, 2})
+    assert results[2] == set()
+    assert rpq.batch_rpq(bd, []) == []
+
+
+def test_rpq_view_updates():
+    bd = MultiDiGraph([(0, 1, {"label": "a"}), (1, 2, {"label": "b"})])
+    query = my_fa.Regex("a b*")
+    view = rpq.RPQView.from_graph(bd, query)
+    assert view.pairs() == rpq.all_pair_rpq_from_graph(bd, query)
+
+    delta = view.add_edges([(2, "b", 3), (2, "b", 3)])
+    assert delta.added == {(State(0), State(3))} and delta.removed == set()
+
+    # one of the two parallel edges is still in the graph
+    assert view.remove_edges([(2, "b", 3)]) == (set(), set())
+    delta = view.update(added=[(4, "a", 2)], removed=[(2, "b", 3), (1, "b", 2)])
+    assert delta.added == {(State(4), State(2))}
+    assert delta.removed == {(State(0), State(2)), (State(0), State(3))}
+    assert view.pairs() == {(State(0), State(1)), (State(4), State(2))}
@@ -0,0 +1,74 @@
+import pytest
+from pyformlang.cfg import Variable, CFG
+from project import graph_utils as gu
+from project.rsm import RSM
+import project.cfqp as cfqp
+from networkx import MultiDiGraph
+
+simple_cfg_text = """
+    S -> A N
+    N -> B C
+    A -> a
+    B -> b
+    C -> c
+    """
+
+
+def test_tensor_all_pair_rpq():
+    gr = MultiDiGraph(
+        [
+            (0, 1, {"label": "a"}),
+            (1, 2, {"label": "b"}),
+            (2, 3, {"label": "c"}),
+            (1, 2, {"label": "d"}),
+        ]
+    )
+
+    cfg = CFG.from_text(simple_cfg_text)
+
+    expected = {
+        (0, Variable("A"), 1),
+        (1, Variable("B"), 2),
+        (2, Variable("C"), 3),
+        (1, Variable("N"), 3),
+        (0, Variable("S"), 3),
+    }
+    res = cfqp.all_pairs_rpq(cfqp.RPQMethods.Tensor, gr, cfg)
+    assert expected == res
+
+
+def test_tensor_from_rsm():
+    gr = MultiDiGraph(
+        [
+            (0, 1, {"label": "a"}),
+            (1, 2, {"label": "a"}),
+            (2, 3, {"label": "b"}),
+            (3, 4, {"label": "b"}),
+        ]
+    )
+    rsm = RSM.from_string_ecfg("S -> a S b | a b")
+
+    expected = {(1, Variable("S"), 3), (0, Variable("S"), 4)}
+    res = cfqp.tensor_rpq(gr, rsm)
+    assert expected == res
+
+
+def test_tensor_with_starts():
+    gr = MultiDiGraph(
+        [(0, 1, {"label": "a"}), (1, 2, {"label": "b"}), (2, 3, {"label": "c"})]
+    )
+
+    cfg = CFG.from_text(simple_cfg_text)
+
+    expected = {(1, Variable("N"), 3), (1, Variable("B"), 2)}
+    res = cfqp.rpq(cfqp.RPQMethods.Tensor, gr, cfg, None, [1])
+    assert expected == res
+
+
+def test_tensor_same_as_matrix_on_two_cycles():
+    gr = gu.generate_two_cycles_graph(3, 4, ("a", "b"))
+    cfg = CFG.from_text("S -> a S b S | $")
+
+    tensor = cfqp.all_pairs_rpq(cfqp.RPQMethods.Tensor, gr, cfg)
+    matrix = cfqp.all_pairs_rpq(cfqp.RPQMethods.Matrix, gr, cfg)
+    assert tensor == {(v, N, u) for (v, N, u) in matrix if N == Variable("S")}